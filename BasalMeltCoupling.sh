@@ -15,6 +15,9 @@ exp_name=$2
 start_dir=$3
 run_dir=$4
 leg_start_date=$5 
+# Optional, last year of the experiment: the coupling server is stopped after
+# the leg ending in this year
+exp_end_date=${6:-}
 
 #start_dir=/perm/nlcd/ecearth3-bisi/r9469-cmip6-bisi-knmi/runtime/classic
 #run_dir=/ec/res4/scratch/nlcd/r9469-cmip6-bisi-knmi/TST2
@@ -26,7 +29,12 @@ leg_end_date=$((leg_start_date + 1))
 echo $leg_end_date
 
 source $start_dir/BasalMeltCoupling/venv/bin/activate
-pip3 install -r $start_dir/BasalMeltCoupling/requirements.txt
+# Only reinstall when requirements changed since the last leg
+if ! cmp -s $start_dir/BasalMeltCoupling/requirements.txt $VIRTUAL_ENV/requirements.installed
+then
+    pip3 install -r $start_dir/BasalMeltCoupling/requirements.txt
+    cp $start_dir/BasalMeltCoupling/requirements.txt $VIRTUAL_ENV/requirements.installed
+fi
 
 # 2. Export correct paths to python
 export PYTHONPATH=`pwd`
@@ -53,51 +61,52 @@ FLATTEN="$BISICLES_HOME/code/filetools/flatten2d.Linux.64.mpiCC.mpif90.DEBUG.OPT
 NC2AMR="$BISICLES_HOME/code/filetools/nctoamr2d.Linux.64.mpiCC.mpif90.DEBUG.OPT.MPI.PETSC.ex"
 DRIVER="$BISICLES_HOME/code/exec2D/driver2d.Linux.64.mpiCC.mpif90.DEBUG.OPT.MPI.PETSC.ex"
 
-### 4. Run basal melt python script    
-python3 $start_dir/BasalMeltCoupling/compute_basalmelt.py $exp_name $gamma $bm_name $start_dir $outpath $nemo_output $NC2AMR ${num} || exit
-
-### 5. Define new basal melt values in input files 
-COUPLED_TEMPLATE="$start_dir/BasalMeltCoupling/BISICLES_submission_template.slurm"
-export COUPLED=$start_dir/BasalMeltCoupling/BISICLES_submission.slurm
-cp $COUPLED_TEMPLATE $COUPLED
-
-sed -i s+@melt+$bm_file+ $COUPLED
-sed -i s+@exp+$exp_name+ $COUPLED
-sed -i s+@out+$outpath+ $COUPLED
-sed -i s+@driver+$DRIVER+ $COUPLED
-sed -i s+@bisi+$BISI_INPUT+ $COUPLED
-sed -i s+@sdir+$start_dir+ $COUPLED
-
-# 6. Get job id and wait for BISICLES to finish running
-jid=$(sbatch $start_dir/BasalMeltCoupling/BISICLES_submission.slurm| cut -d ' ' -f4)
-echo $jid
-echo "waiting for BISICLES..."
-until test -f "$start_dir/BasalMeltCoupling/$jid.txt"
-do
-    sleep 60
-done
-rm $start_dir/BasalMeltCoupling/$jid.txt
-
-if test -f $start_dir/BasalMeltCoupling/err.0
-    then
-    if grep -q "srun: error:" "$start_dir/BasalMeltCoupling/err.0"
-    then
-        echo "BISICLES encountered an error, exiting."
-        exit
-    fi
+### Stage timings of each leg are appended to $outpath/csv/${exp_name}_timing.jsonl,
+### uncomment to also write a cProfile dump of each leg (read when the server starts)
+#export COUPLING_PROFILE=1
+### uncomment to compute the sector means on a local dask cluster with 8 workers,
+### for high resolution ocean grids (needs dask.distributed)
+#export COUPLING_DASK_WORKERS=8
+### uncomment for spatially resolved basal melt, from the 4 nearest ocean columns
+### of each BISICLES cell
+#export COUPLING_MELT_FIELD=4
+### uncomment to use another set of ocean sectors, the name of a set in
+### freshwater_coupling/sector_sets or a json file with the same layout
+#export COUPLING_SECTOR_SET=levermann
+
+### Coupling server, kept alive between legs so grid weights and masks stay in memory
+socket=$start_dir/BasalMeltCoupling/coupling.sock
+client=$start_dir/BasalMeltCoupling/coupling_client.py
+if ! python3 $client $socket ping > /dev/null 2>&1
+then
+    # A socket left by a server that did not shut down refuses connections
+    rm -f $socket
+    PYTHONPATH=$start_dir/BasalMeltCoupling nohup python3 -m freshwater_coupling.service $socket > $start_dir/BasalMeltCoupling/coupling_server.log 2>&1 &
+    for i in $(seq 100); do python3 $client $socket ping > /dev/null 2>&1 && break; sleep 0.1; done
 fi
 
-echo "...BISICLES done!"
-
-# 7. Check whether plot files exist, if they do calculate freshwater
-if test -n "$(find $plots -type f -name "plot.$exp_name.??????.2d.hdf5" -print -quit)"
-    then
-    echo "Found plot, calculating freshwater"
-    python3 $start_dir/BasalMeltCoupling/compute_freshwater.py $exp_name $start_dir $FLATTEN $outpath $nemo_output ${num} || exit
-    cp -p $run_dir/output/bisicles/csv/freshwater_forcing.nc $start_dir/BasalMeltCoupling/inputs/forcing/$exp_name/FWF_LRF_y${leg_end_date}.nc
-    else
-    echo "Something went wrong, no plot"
-    exit 
+### 4. Run the leg: basal melt, BISICLES and freshwater. The freshwater
+### preparation overlaps with BISICLES, run directly if the server is not reachable
+set +e
+python3 $client $socket leg $exp_name $gamma $bm_name $start_dir $outpath $nemo_output $NC2AMR $FLATTEN $DRIVER $BISI_INPUT
+status=$?
+set -e
+if [ $status -eq 2 ]
+then
+    python3 $start_dir/BasalMeltCoupling/run_leg.py $exp_name $gamma $bm_name $start_dir $outpath $nemo_output $NC2AMR $FLATTEN $DRIVER $BISI_INPUT || exit
+elif [ $status -ne 0 ]
+then
+    exit $status
+fi
+
+### 5. The freshwater forcing for the next leg is written directly to
+### inputs/forcing/$exp_name/FWF_LRF_y${leg_end_date}.nc
+test -f $start_dir/BasalMeltCoupling/inputs/forcing/$exp_name/FWF_LRF_y${leg_end_date}.nc || exit
+
+### 6. Stop the coupling server after the last leg of the experiment
+if [ -n "$exp_end_date" ] && [ $leg_end_date -ge $exp_end_date ]
+then
+    python3 $client $socket shutdown || true
 fi
 
 echo "Done!"
\ No newline at end of file
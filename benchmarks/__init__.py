@@ -0,0 +1 @@
+"""Benchmarks of the coupling hot paths on synthetic inputs"""
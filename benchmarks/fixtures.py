@@ -0,0 +1,278 @@
+"""This module creates synthetic EC-Earth and BISICLES input files for the
+benchmarks: NEMO grid_T_3D and areacello files on ORCA-like grids, ocean
+distribution masks, Chombo plot files and Levermann region masks on
+Antarctic ice grids.
+
+Classes: OceanFixture, IceFixture
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+
+try:
+    import h5py
+except ImportError:  # plot files need h5py
+    h5py = None
+
+# (j, i, lev) of the ocean grids
+OCEAN_GRIDS = {
+    "test": (60, 90, 30),
+    "ORCA1": (292, 362, 75),
+    "ORCA025": (1050, 1442, 75),
+}
+
+# Cells per side of the ice grids, on the 6144 km BISICLES Antarctic domain
+ICE_GRIDS = {
+    "8km": 768,
+    "4km": 1536,
+    "2km": 3072,
+    "1km": 6144,
+}
+
+
+class OceanFixture:
+    """Class for synthetic NEMO output on an ORCA-like grid
+    ...
+
+    Latitude runs from 78S to 90N along j, longitude from 0 to 360E along i,
+    so every Levermann sector is covered. Land is nan, as in NEMO output.
+
+    Attributes
+    ----------
+    path (str): directory of the fixture files
+    grid (str): name of the grid in OCEAN_GRIDS
+    months (int): number of time steps of the thetao file
+    seed (int): seed of the random temperatures
+
+    Methods
+    -------
+    thetao_file, area_file, basal_melt_mask_file, calving_mask_file
+        Paths of the fixture files
+    coordinates
+        Latitude, longitude and layer bounds of the grid
+    create
+        Write the fixture files that do not exist yet
+    """
+
+    def __init__(self, path, grid, months=12, seed=0):
+        assert grid in OCEAN_GRIDS, "unknown ocean grid " + grid
+        self.path = os.path.join(path, "ocean_" + grid)
+        self.grid = grid
+        self.months = months
+        self.seed = seed
+
+    def thetao_file(self):
+        """Path of the grid_T_3D file"""
+        return os.path.join(self.path, "bench_1m_18500101_18501231_grid_T_3D.nc")
+
+    def area_file(self):
+        """Path of the areacello file"""
+        return os.path.join(self.path, "areacello.nc")
+
+    def basal_melt_mask_file(self):
+        """Path of the basal melt distribution mask"""
+        return os.path.join(self.path, "basal_melt_mask.nc")
+
+    def calving_mask_file(self):
+        """Path of the calving distribution mask"""
+        return os.path.join(self.path, "calving_mask.nc")
+
+    def coordinates(self):
+        """Latitude, longitude and layer bounds of the grid
+        Returns:
+            lat, lon (np.array): (j, i) co-ordinates and lev_bnds (np.array):
+            (lev, 2) layer bounds, thickening with depth to 6000 m
+        """
+        n_j, n_i, n_lev = OCEAN_GRIDS[self.grid]
+        lat = np.linspace(-78, 90, n_j)[:, None] + np.zeros((n_j, n_i))
+        lon = np.linspace(0, 360, n_i, endpoint=False)[None, :] + np.zeros((n_j, n_i))
+        thickness = np.linspace(1, 20, n_lev)
+        edges = np.concatenate([[0], np.cumsum(thickness / thickness.sum() * 6000)])
+        return lat, lon, np.stack([edges[:-1], edges[1:]], axis=1)
+
+    def create(self):
+        """Write the fixture files that do not exist yet"""
+        os.makedirs(self.path, exist_ok=True)
+        lat, lon, lev_bnds = self.coordinates()
+        n_j, n_i, n_lev = OCEAN_GRIDS[self.grid]
+        rng = np.random.default_rng(self.seed)
+        land = rng.random((n_j, n_i)) < 0.3
+
+        if not os.path.exists(self.area_file()):
+            area = 1e10 * np.cos(np.deg2rad(lat)) + 1.0
+            area[land] = np.nan
+            xr.Dataset(
+                {"areacello": (("j", "i"), area)},
+                coords={"latitude": (("j", "i"), lat), "longitude": (("j", "i"), lon)},
+            ).to_netcdf(self.area_file())
+
+        if not os.path.exists(self.basal_melt_mask_file()):
+            mask = ((lat < -70) & ~land).astype(float)
+            xr.Dataset({"basal_melt_mask": (("j", "i"), mask)}).to_netcdf(
+                self.basal_melt_mask_file()
+            )
+        if not os.path.exists(self.calving_mask_file()):
+            mask = ((lat >= -70) & (lat < -60) & ~land).astype(float)
+            xr.Dataset({"calving_mask": (("j", "i"), mask)}).to_netcdf(
+                self.calving_mask_file()
+            )
+
+        if not os.path.exists(self.thetao_file()):
+            # Written one month at a time, ORCA025 does not fit in memory at once
+            tmp_file = self.thetao_file() + ".tmp"
+            time = pd.date_range("1850-01-01", periods=self.months, freq="MS")
+            with netCDF4.Dataset(tmp_file, "w") as nc:
+                nc.createDimension("time_counter", None)
+                nc.createDimension("olevel", n_lev)
+                nc.createDimension("y", n_j)
+                nc.createDimension("x", n_i)
+                nc.createDimension("axis_nbounds", 2)
+                time_var = nc.createVariable("time_counter", "f8", ("time_counter",))
+                time_var.units = "days since 1850-01-01"
+                time_var.calendar = "gregorian"
+                nc.createVariable("olevel", "f4", ("olevel",))[:] = lev_bnds.mean(1)
+                nc.createVariable("olevel_bounds", "f4", ("olevel", "axis_nbounds"))[
+                    :
+                ] = lev_bnds
+                nc.createVariable("nav_lat", "f4", ("y", "x"))[:] = lat
+                nc.createVariable("nav_lon", "f4", ("y", "x"))[:] = lon
+                thetao = nc.createVariable(
+                    "thetao",
+                    "f4",
+                    ("time_counter", "olevel", "y", "x"),
+                    fill_value=np.float32(1e20),
+                    chunksizes=(1, 1, n_j, n_i),
+                )
+                for month in range(self.months):
+                    time_var[month] = (time[month] - time[0]).days + 15
+                    field = rng.normal(0.5, 1.0, (n_lev, n_j, n_i)).astype("f4")
+                    field[:, land] = np.nan
+                    thetao[month] = np.ma.masked_invalid(field)
+            os.replace(tmp_file, self.thetao_file())
+
+
+class IceFixture:
+    """Class for synthetic BISICLES plot files and Levermann region masks
+    ...
+
+    The five regions are wedges around the domain centre inside a disc, and
+    the plot files are single level Chombo files with one ghost cell.
+
+    Attributes
+    ----------
+    path (str): directory of the fixture files
+    grid (str): name of the grid in ICE_GRIDS
+    box (int): size of the AMR boxes of the plot files
+    seed (int): seed of the random fields
+
+    Methods
+    -------
+    mask_path, plot_file
+        Paths of the fixture files
+    write_plot
+        Write a single level Chombo plot file
+    create
+        Write the fixture files that do not exist yet
+    """
+
+    regions = ["eais", "wedd", "amun", "ross", "apen"]
+    variables = ["thickness", "activeSurfaceThicknessSource", "activeBasalThicknessSource"]
+    domain = 6144000.0
+
+    def __init__(self, path, grid, box=256, seed=0):
+        assert grid in ICE_GRIDS, "unknown ice grid " + grid
+        self.path = os.path.join(path, "ice_" + grid)
+        self.grid = grid
+        self.box = box
+        self.seed = seed
+
+    def mask_path(self):
+        """Directory of the Levermann region masks"""
+        return os.path.join(self.path, "masks") + "/"
+
+    def plot_file(self, step):
+        """Path of the plot file of a time step (1 or 2)"""
+        return os.path.join(self.path, "plot.bench.{:06d}.2d.hdf5".format(step))
+
+    def write_plot(self, file, fields, dx):
+        """Write a single level Chombo plot file
+        Args:
+            file (str): path to plot file
+            fields (dict): (y, x) field of each variable
+            dx (float): cell size
+        """
+        if h5py is None:
+            raise ImportError("h5py is required to write plot files")
+        names = list(fields)
+        n_y, n_x = fields[names[0]].shape
+        box_type = np.dtype(
+            [("lo_i", "<i4"), ("lo_j", "<i4"), ("hi_i", "<i4"), ("hi_j", "<i4")]
+        )
+        padded = {name: np.pad(field, 1, mode="edge") for name, field in fields.items()}
+        boxes, offsets, chunks = [], [], []
+        offset = 0
+        for j_0 in range(0, n_y, self.box):
+            for i_0 in range(0, n_x, self.box):
+                j_1 = min(j_0 + self.box, n_y) - 1
+                i_1 = min(i_0 + self.box, n_x) - 1
+                boxes.append((i_0, j_0, i_1, j_1))
+                offsets.append(offset)
+                for name in names:
+                    chunk = padded[name][j_0 : j_1 + 3, i_0 : i_1 + 3].ravel()
+                    chunks.append(chunk)
+                    offset += chunk.size
+        offsets.append(offset)
+
+        tmp_file = file + ".tmp"
+        with h5py.File(tmp_file, "w") as amr:
+            amr.attrs["num_components"] = len(names)
+            amr.attrs["num_levels"] = 1
+            amr.attrs["time"] = 0.0
+            for n, name in enumerate(names):
+                amr.attrs["component_" + str(n)] = np.bytes_(name)
+            level = amr.create_group("level_0")
+            level.attrs["dx"] = dx
+            level.attrs["prob_domain"] = np.array((0, 0, n_x - 1, n_y - 1), dtype=box_type)
+            level.create_group("data_attributes").attrs["outputGhost"] = np.array(
+                (1, 1), dtype=[("intvecti", "<i4"), ("intvectj", "<i4")]
+            )
+            level["boxes"] = np.array(boxes, dtype=box_type)
+            level["data:offsets=0"] = np.array(offsets, dtype="<i8")
+            level["data:datatype=0"] = np.concatenate(chunks)
+        os.replace(tmp_file, file)
+
+    def create(self):
+        """Write the fixture files that do not exist yet"""
+        n = ICE_GRIDS[self.grid]
+        dx = self.domain / n
+        os.makedirs(self.mask_path(), exist_ok=True)
+        y_idx, x_idx = np.meshgrid(np.arange(n), np.arange(n), indexing="ij")
+        angle = np.arctan2(y_idx - n / 2, x_idx - n / 2)
+        radius = np.hypot(y_idx - n / 2, x_idx - n / 2)
+        ice = radius < 0.45 * n
+        edges = np.linspace(-np.pi, np.pi, len(self.regions) + 1)
+        coords = -self.domain / 2 + (np.arange(n) + 0.5) * dx
+        for k, name in enumerate(self.regions):
+            file = os.path.join(self.mask_path(), "levermann_" + name + "_1.2d.nc")
+            if os.path.exists(file):
+                continue
+            mask = (angle >= edges[k]) & (angle < edges[k + 1]) & ice
+            xr.Dataset(
+                {"smask": (("y", "x"), mask.astype(float))},
+                coords={"x": coords, "y": coords},
+            ).to_netcdf(file)
+
+        rng = np.random.default_rng(self.seed)
+        thickness = np.where(ice, 2000.0 * (1 - radius / n), 0.0)
+        for step in (1, 2):
+            if os.path.exists(self.plot_file(step)):
+                continue
+            fields = {
+                "thickness": thickness + rng.normal(0, 1, (n, n)) * ice,
+                "activeSurfaceThicknessSource": rng.normal(0.1, 0.05, (n, n)) * ice,
+                "activeBasalThicknessSource": rng.normal(-0.5, 0.2, (n, n)) * ice,
+            }
+            self.write_plot(self.plot_file(step), fields, dx)
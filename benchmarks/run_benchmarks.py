@@ -0,0 +1,274 @@
+"""Benchmarks of the coupling hot paths
+
+This script times the sector means of ocean temperature, the regional sums
+of BISICLES plot files, the NEMO forcing calculation and the mapping of
+basal melt to the ice grid, sector-wise and spatially resolved, on synthetic
+inputs (see fixtures.py). Each case runs in its own process, so its peak
+memory is not hidden by earlier cases.
+Wall times and peak memory are written to a JSON file, which can be
+compared with an earlier one.
+
+Run from the BasalMeltCoupling directory, e.g.
+python -m benchmarks.run_benchmarks --ocean ORCA1 --ice 8km 4km --compare old.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import resource
+import multiprocessing
+from datetime import datetime
+import pandas as pd
+
+from benchmarks.fixtures import OCEAN_GRIDS, ICE_GRIDS, OceanFixture, IceFixture
+from freshwater_coupling import basal_melt as BM
+from freshwater_coupling import freshwater as FW
+from freshwater_coupling.amr_tools import Flatten as flt
+from freshwater_coupling.antarctic_sectors import LevermannSectors as levermann
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def rss_mb():
+    """Current resident memory of this process
+    Returns:
+        rss (float): resident memory in MB
+    """
+    with open("/proc/self/statm") as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() / 2**20
+
+
+def weighted_mean_df(ocean, ice, workdir):
+    """Sector means of one year of thetao, the first run builds the operator"""
+    ocean_temp = BM.OceanData(ocean.thetao_file(), ocean.area_file())
+    return ocean_temp.weighted_mean_df
+
+
+def mask_region(ocean, ice, workdir):
+    """Sums of one plot file over each region, one region at a time"""
+    freshwater = FW.Freshwater(None, ice.plot_file(1), ice.plot_file(2))
+    dat = flt(ice.plot_file(1)).read(freshwater.variables)
+    _, weights = freshwater.region_weights(
+        ice.mask_path(), dat.thickness.shape, os.path.join(workdir, "cache")
+    )
+
+    def run():
+        return [freshwater.mask_region(dat, weight) for weight in weights]
+
+    return run
+
+
+def regional_contribution(ocean, ice, workdir):
+    """Calving and basal melt of each region from two plot files, the first
+    run builds the region weights"""
+    freshwater = FW.Freshwater(None, ice.plot_file(1), ice.plot_file(2))
+    cache_dir = os.path.join(workdir, "cache")
+
+    def run():
+        freshwater.sums_cache.clear()
+        return freshwater.regional_contribution(
+            ice.mask_path(), workdir + "/", None, True, cache_dir
+        )
+
+    return run
+
+
+def calculate_nemo_forcing(ocean, ice, workdir):
+    """NEMO forcing from regional totals, the first run builds the
+    distribution kernel"""
+    freshwater = FW.Freshwater(None, None, None)
+    regions = IceFixture.regions
+    discharge = pd.DataFrame([[50.0] * len(regions)], columns=regions)
+    basal = pd.DataFrame([[-30.0] * len(regions)], columns=regions)
+
+    def run():
+        return freshwater.calculate_nemo_forcing(
+            discharge,
+            basal,
+            ocean.area_file(),
+            ocean.basal_melt_mask_file(),
+            ocean.calving_mask_file(),
+            ocean.thetao_file(),
+        )
+
+    return run
+
+
+def map2amr(ocean, ice, workdir):
+    """Basal melt mapped to the ice grid and written to netcdf, the nc2amr
+    driver is replaced by true"""
+    sectors = BM.OceanData.sectors
+    basalmelt_df = pd.DataFrame([[1.0] * len(sectors)], columns=sectors)
+
+    def run():
+        return levermann().map2amr(
+            ice.mask_path(), workdir + "/", shutil.which("true"), "bench_bm", basalmelt_df
+        )
+
+    return run
+
+
+def melt_field(ocean, ice, workdir):
+    """Basal melt of each ocean column interpolated to the ice grid, the
+    first run builds the interpolation matrix"""
+    ocean_temp = BM.BasalMelt(
+        ocean.thetao_file(), ocean.area_file(), 0.05, os.path.join(workdir, "cache")
+    )
+
+    def run():
+        return ocean_temp.thetao2basalmelt_field(ice.mask_path())
+
+    return run
+
+
+# Benchmark cases and the fixtures they use
+CASES = {
+    "weighted_mean_df": ("ocean", weighted_mean_df),
+    "mask_region": ("ice", mask_region),
+    "regional_contribution": ("ice", regional_contribution),
+    "calculate_nemo_forcing": ("ocean", calculate_nemo_forcing),
+    "map2amr": ("ice", map2amr),
+    "melt_field": ("both", melt_field),
+}
+
+
+def run_case(args):
+    """Run one benchmark case, in a worker process of its own
+    Args:
+        args (tuple): case name, ocean grid, ice grid, data directory, repeats
+    Returns:
+        result (dict): wall times and memory of the case
+    """
+    name, ocean_grid, ice_grid, datadir, repeat = args
+    ocean = OceanFixture(datadir, ocean_grid) if ocean_grid else None
+    ice = IceFixture(datadir, ice_grid) if ice_grid else None
+    workdir = os.path.join(datadir, "work_" + str(os.getpid()))
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        baseline = rss_mb()
+        setup_start = time.perf_counter()
+        run = CASES[name][1](ocean, ice, workdir)
+        setup = time.perf_counter() - setup_start
+        wall = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            wall.append(time.perf_counter() - start)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "case": name,
+        "grid": "/".join(grid for grid in (ocean_grid, ice_grid) if grid),
+        "setup_s": setup,
+        "wall_s": wall,
+        "first_s": wall[0],
+        "min_s": min(wall),
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": peak,
+        "peak_increase_mb": peak - baseline,
+    }
+
+
+def compare(results, reference, tolerance):
+    """Compare minimum wall times with an earlier benchmark run
+    Args:
+        results (list): results of this run
+        reference (list): results of the earlier run
+        tolerance (float): ratio of wall times counted as a regression
+    Returns:
+        regressions (list): (case, grid, ratio) of slower cases
+    """
+    earlier = {(res["case"], res["grid"]): res for res in reference}
+    regressions = []
+    print("\n{:<24}{:<10}{:>12}{:>12}{:>8}".format("case", "grid", "before s", "now s", "ratio"))
+    for res in results:
+        key = (res["case"], res["grid"])
+        if key not in earlier:
+            continue
+        ratio = res["min_s"] / earlier[key]["min_s"]
+        print(
+            "{:<24}{:<10}{:>12.4f}{:>12.4f}{:>8.2f}".format(
+                key[0], key[1], earlier[key]["min_s"], res["min_s"], ratio
+            )
+        )
+        if ratio > tolerance:
+            regressions.append((key[0], key[1], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ocean", nargs="*", default=["ORCA1"], choices=list(OCEAN_GRIDS))
+    parser.add_argument("--ice", nargs="*", default=["8km", "4km"], choices=list(ICE_GRIDS))
+    parser.add_argument("--cases", nargs="*", default=list(CASES), choices=list(CASES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--datadir", default=os.path.join(os.path.dirname(RESULTS_DIR), "data")
+    )
+    parser.add_argument("--output", help="results file, default in benchmarks/results")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    runs = []
+    for name in args.cases:
+        kind = CASES[name][0]
+        ocean_grids = args.ocean if kind in ("ocean", "both") else [None]
+        ice_grids = args.ice if kind in ("ice", "both") else [None]
+        for ocean_grid in ocean_grids:
+            for ice_grid in ice_grids:
+                if ocean_grid:
+                    OceanFixture(args.datadir, ocean_grid).create()
+                if ice_grid:
+                    IceFixture(args.datadir, ice_grid).create()
+                runs.append((name, ocean_grid, ice_grid, args.datadir, args.repeat))
+
+    results = []
+    context = multiprocessing.get_context("fork")
+    for run in runs:
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            res = pool.apply(run_case, (run,))
+        results.append(res)
+        print(
+            "{case:<24}{grid:<10} first {first_s:8.4f} s  min {min_s:8.4f} s  "
+            "peak {peak_rss_mb:8.1f} MB (+{peak_increase_mb:.1f})".format(**res)
+        )
+
+    output = args.output or os.path.join(
+        RESULTS_DIR,
+        "{}_{}.json".format(socket.gethostname(), datetime.now().strftime("%Y%m%dT%H%M%S")),
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as out:
+        json.dump(
+            {
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "host": socket.gethostname(),
+                "python": platform.python_version(),
+                "repeat": args.repeat,
+                "results": results,
+            },
+            out,
+            indent=1,
+        )
+    print("Results written to", output)
+
+    if args.compare:
+        with open(args.compare) as ref:
+            regressions = compare(results, json.load(ref)["results"], args.tolerance)
+        for case, grid, ratio in regressions:
+            print("Regression: {} on {} is {:.2f}x slower".format(case, grid, ratio))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
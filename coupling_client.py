@@ -0,0 +1,42 @@
+"""Coupling Client
+
+This script sends one coupling step to the coupling server and waits for it
+to finish, so each leg does not have to start a new interpreter and rebuild
+grid weights and masks.
+
+Usage:
+    python3 coupling_client.py <socket> basalmelt <args of compute_basalmelt.py>
+    python3 coupling_client.py <socket> freshwater <args of compute_freshwater.py>
+    python3 coupling_client.py <socket> ping
+    python3 coupling_client.py <socket> shutdown
+
+The server is started with
+    python3 -m freshwater_coupling.service <socket>
+
+Exits with status 2 if no server is listening on the socket, so the caller
+can fall back to running the compute scripts directly. A ping request only
+checks that a server is listening.
+"""
+
+import sys
+import json
+import socket
+
+SOCKET_PATH = str(sys.argv[1])
+TASK = str(sys.argv[2])
+ARGS = sys.argv[3:]
+
+if __name__ == "__main__":
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(SOCKET_PATH)
+        except (FileNotFoundError, ConnectionRefusedError):
+            print("no coupling server on " + SOCKET_PATH, file=sys.stderr)
+            sys.exit(2)
+        request = {"task": TASK, "args": ARGS}
+        client.sendall((json.dumps(request) + "\n").encode())
+        response = json.loads(client.makefile().readline())
+    if response["status"] != "ok":
+        print(response["error"], file=sys.stderr)
+        sys.exit(1)
+    print(TASK + " done")
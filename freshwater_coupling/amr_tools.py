@@ -5,11 +5,18 @@ classes: Flatten, Masks
 """
 
 import os
+import hashlib
 import subprocess
 from glob import glob
 import numpy as np
 import pandas as pd
 import xarray as xr
+from freshwater_coupling import instrumentation as IN
+
+try:
+    import h5py
+except ImportError:  # only needed to read AMR files without flatten
+    h5py = None
 
 
 class Flatten:
@@ -27,6 +34,8 @@ class Flatten:
         flatten amr file to netcdf
     open
         flatten amr file and open dataset
+    read
+        read a level of the amr file directly into a dataset
     flattenMean
         Take mean of each variable in flattened file
     flattenSum
@@ -59,12 +68,13 @@ class Flatten:
         """
         name = self.find_name()
         nc_name = path + name + ".nc"
-        flatten_output = subprocess.Popen(
-            [flatten, self.file, nc_name, "0", "-3333500", "-3333500"],
-            stdout=subprocess.PIPE,
-        )
-        # assess
-        flatten_output.communicate()[0]
+        with IN.stage("flatten", tool=True):
+            flatten_output = subprocess.Popen(
+                [flatten, self.file, nc_name, "0", "-3333500", "-3333500"],
+                stdout=subprocess.PIPE,
+            )
+            # assess
+            flatten_output.communicate()[0]
 
     def open(self, flatten, path):
         """Flatten AMR file and open it
@@ -81,6 +91,69 @@ class Flatten:
         assert dat.time.size != 0, "dataset is empty"
         return dat
 
+    def read(self, variables=None, level=0, x0=-3333500, y0=-3333500):
+        """Read one level of the Chombo AMR file directly into a dataset,
+        without running flatten or writing a netcdf
+        Args:
+            variables (list of str): names of variables to read, all if None
+            level (int): AMR level, cells not covered by that level are nan
+            x0, y0 (float): co-ordinates of the domain origin, as given to flatten
+        Returns:
+            xarray dataset of the AMR level, with (y, x) variables like the
+            flattened BISICLES file
+        """
+        if h5py is None:
+            raise ImportError("h5py is required to read AMR files natively")
+        with h5py.File(self.file, "r") as amr:
+            names = [
+                amr.attrs["component_" + str(n)]
+                for n in range(int(amr.attrs["num_components"]))
+            ]
+            names = [n.decode() if isinstance(n, bytes) else str(n) for n in names]
+            if variables is None:
+                variables = names
+            comps = [names.index(var) for var in variables]
+            time = float(amr.attrs.get("time", 0.0))
+
+            amr_level = amr["level_" + str(level)]
+            dx = float(amr_level.attrs["dx"])
+            domain = amr_level.attrs["prob_domain"]
+            n_x = int(domain["hi_i"]) - int(domain["lo_i"]) + 1
+            n_y = int(domain["hi_j"]) - int(domain["lo_j"]) + 1
+            ghost = (0, 0)
+            if "data_attributes" in amr_level:
+                attrs = amr_level["data_attributes"].attrs
+                if "outputGhost" in attrs:
+                    ghost = tuple(int(g) for g in attrs["outputGhost"].tolist())
+
+            fields = {var: np.full((n_y, n_x), np.nan) for var in variables}
+            boxes = amr_level["boxes"][:]
+            offsets = amr_level["data:offsets=0"][:]
+            data = amr_level["data:datatype=0"]
+            for box, offset in zip(boxes, offsets):
+                lo_i = int(box["lo_i"]) - int(domain["lo_i"])
+                lo_j = int(box["lo_j"]) - int(domain["lo_j"])
+                box_x = int(box["hi_i"]) - int(box["lo_i"]) + 1
+                box_y = int(box["hi_j"]) - int(box["lo_j"]) + 1
+                size_x = box_x + 2 * ghost[0]
+                size_y = box_y + 2 * ghost[1]
+                n_cells = size_x * size_y
+                for var, comp in zip(variables, comps):
+                    # Box data is stored per component in Fortran order
+                    start = int(offset) + comp * n_cells
+                    vals = data[start : start + n_cells].reshape(size_y, size_x)
+                    vals = vals[ghost[1] : ghost[1] + box_y, ghost[0] : ghost[0] + box_x]
+                    fields[var][lo_j : lo_j + box_y, lo_i : lo_i + box_x] = vals
+
+        x = x0 + (np.arange(n_x) + 0.5) * dx
+        y = y0 + (np.arange(n_y) + 0.5) * dx
+        dat = xr.Dataset(
+            {var: (("y", "x"), val) for var, val in fields.items()},
+            coords={"x": x, "y": y, "time": [time]},
+        )
+        assert dat.time.size != 0, "dataset is empty"
+        return dat
+
     def flatten_mean(self, flatten_dat):
         """Take mean of each variable in flattened file
         Args:
@@ -148,31 +221,235 @@ class Masks:
     Attributes
     ----------
     path (str): path to mask files
+    cache_dir (str): directory of the mask store and weight caches, the mask
+        directory if None. Without write access to it the products are
+        computed every time
 
     Methods
     -------
+    region_name
+        Region name of a mask file
+    read_masks
+        Open region masks from the netcdf mask files
     bisicles_masks
         Method opening region masks and creating a dictionary containing them
-
+    label_map
+        Single int8 raster labelling the region of each cell
+    cache_prefix
+        File name prefix of a cached product of this mask directory
+    clear_cache
+        Remove outdated cache files
+    mask_files
+        List the region mask files
+    files_key
+        Hash names, sizes and modification times of the mask files
+    coarsen
+        Fraction of each coarse cell covered by a mask
+    region_weights
+        Stack of region coverage fractions on a coarser grid, cached on disk
     """
 
-    def __init__(self, path):
+    # Axis order of the mask store and of all mask products
+    axis_order = ("y", "x")
+
+    def __init__(self, path, cache_dir=None):
         self.path = path
+        self.cache_dir = path if cache_dir is None else cache_dir
 
-    def bisicles_masks(self):
-        """Open region masks and create dictionary
+    def region_name(self, file):
+        """Region name of a mask file
+        Args:
+            file (str): path to mask file
         Returns:
-            x,y co-ordinate np.array and bisicles_mask (np.array) of each Antarctic region
+            name (str): region name
+        """
+        name = os.path.splitext(os.path.basename(file))[0][10:-5]
+        return str(name)
+
+    def read_masks(self):
+        """Open region masks from the netcdf mask files
+        Returns:
+            x,y co-ordinate np.array and (y, x) bisicles_mask (np.array) of
+            each Antarctic region
         """
-        nc_files = glob(os.path.join(self.path, "*.2d.nc"))
         bisicles_masks = {}
-        for file in nc_files:
-            key = os.path.splitext(os.path.basename(file))[0][10:-5]
-            name = str(key)
-            dat = xr.open_dataset(file)
-            bisicles_masks[name] = np.array(dat["smask"])
+        for file in self.mask_files():
+            with xr.open_dataset(file) as dat:
+                # The rest of the coupling indexes masks as (y, x)
+                smask = dat["smask"].transpose("y", "x")
+                bisicles_masks[self.region_name(file)] = np.array(smask)
+                x = np.array(dat["x"])
+                y = np.array(dat["y"])
         assert len(bisicles_masks) != 0, "Dictionary should not be empty"
-
-        x = np.array(dat["x"])
-        y = np.array(dat["y"])
         return x, y, bisicles_masks
+
+    def bisicles_masks(self):
+        """Open region masks and create dictionary. The masks are converted once
+        into a uint8 (region, y, x) store in cache_dir, which later calls
+        memory-map. The store is rebuilt when the mask files change
+        Returns:
+            x,y co-ordinate np.array and bisicles_mask (np.array) of each Antarctic region
+        """
+        key = self.files_key("mask_store")
+        prefix = self.cache_prefix("mask_store_")
+        store_file = os.path.join(self.cache_dir, prefix + key[:16] + ".npy")
+        meta_file = os.path.join(self.cache_dir, prefix + key[:16] + ".npz")
+        if os.path.exists(store_file) and os.path.exists(meta_file):
+            with np.load(meta_file) as meta:
+                if str(meta["key"]) == key:
+                    names = [str(name) for name in meta["names"]]
+                    x = meta["x"]
+                    y = meta["y"]
+                    store = np.load(store_file, mmap_mode="r")
+                    return x, y, {name: store[k] for k, name in enumerate(names)}
+
+        x, y, masks = self.read_masks()
+        names = sorted(masks)
+        store = np.stack([np.nan_to_num(masks[name]) == 1 for name in names])
+        store = store.astype(np.uint8)
+        try:
+            self.clear_cache(prefix)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_file = store_file + "." + str(os.getpid()) + ".tmp.npy"
+            np.save(tmp_file, store)
+            os.replace(tmp_file, store_file)
+            tmp_file = meta_file + "." + str(os.getpid()) + ".tmp.npz"
+            np.savez(tmp_file, names=np.array(names), x=x, y=y, key=np.array(key))
+            os.replace(tmp_file, meta_file)
+        except OSError:
+            # Read-only cache directory, work from the netcdf masks
+            pass
+        return x, y, {name: store[k] for k, name in enumerate(names)}
+
+    def label_map(self, order):
+        """Single int8 raster labelling the region of each cell. Where masks
+        overlap, the region later in order takes precedence
+        Args:
+            order (list of str): region names, label k + 1 is order[k]
+        Returns:
+            x,y co-ordinate np.array and label (np.array): 0 outside all
+            regions, k + 1 inside region order[k]
+        """
+        x, y, masks = self.bisicles_masks()
+        key = self.files_key("label_map", list(order))
+        prefix = self.cache_prefix("label_map_", list(order))
+        label_file = os.path.join(self.cache_dir, prefix + key[:16] + ".npy")
+        if os.path.exists(label_file):
+            return x, y, np.load(label_file, mmap_mode="r")
+
+        label = np.zeros(masks[order[0]].shape, dtype=np.int8)
+        for k, name in enumerate(order):
+            label[masks[name] == 1] = k + 1
+        try:
+            self.clear_cache(prefix)
+            tmp_file = label_file + "." + str(os.getpid()) + ".tmp.npy"
+            np.save(tmp_file, label)
+            os.replace(tmp_file, label_file)
+        except OSError:
+            pass
+        return x, y, label
+
+    def cache_prefix(self, name, *params):
+        """File name prefix of a cached product of this mask directory. The
+        cache directory may be shared with other mask directories, the
+        prefix tells their files apart
+        Args:
+            name (str): name of the product, e.g. mask_store_
+            params: further values the product depends on, other than the
+            mask files themselves
+        Returns:
+            prefix (str)
+        """
+        scope = hashlib.sha256(
+            repr((os.path.abspath(self.path), params)).encode()
+        ).hexdigest()
+        return name + scope[:8] + "_"
+
+    def clear_cache(self, prefix):
+        """Remove outdated cache files
+        Args:
+            prefix (str): file name prefix of the cache, see cache_prefix
+        """
+        for file in glob(os.path.join(self.cache_dir, prefix + "*")):
+            os.remove(file)
+
+    def mask_files(self):
+        """List the region mask files
+        Returns:
+            sorted list of mask file paths
+        """
+        return sorted(glob(os.path.join(self.path, "*.2d.nc")))
+
+    def files_key(self, *params):
+        """Hash names, sizes and modification times of the mask files
+        Args:
+            params: further values the cached product depends on
+        Returns:
+            key (str): hex digest
+        """
+        digest = hashlib.sha256()
+        for file in self.mask_files():
+            stat = os.stat(file)
+            digest.update(
+                "{}:{}:{}".format(
+                    os.path.basename(file), stat.st_size, stat.st_mtime_ns
+                ).encode()
+            )
+        # Caches from before masks were read as (y, x) may be transposed
+        digest.update(repr((self.axis_order, params)).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def coarsen(mask, shape):
+        """Fraction of each coarse cell covered by a mask, the block mean of the
+        mask over the fine cells making up each coarse cell
+        Args:
+            mask (np.array): fine resolution mask of zeros and ones
+            shape (tuple): shape of the coarse grid, an integer factor coarser
+        Returns:
+            coverage (np.array): fraction of each coarse cell inside the mask
+        """
+        factor_y = mask.shape[0] // shape[0]
+        factor_x = mask.shape[1] // shape[1]
+        assert (
+            factor_y * shape[0] == mask.shape[0] and factor_x * shape[1] == mask.shape[1]
+        ), "mask is not an integer factor finer than the grid"
+        blocks = np.nan_to_num(mask).astype(float).reshape(
+            shape[0], factor_y, shape[1], factor_x
+        )
+        coverage = blocks.mean(axis=(1, 3))
+        return coverage
+
+    def region_weights(self, shape, cache_dir=None):
+        """Stack of region coverage fractions on a coarser grid. The stack is
+        stored in cache_dir and rebuilt when the mask files change
+        Args:
+            shape (tuple): shape of the coarse grid
+            cache_dir (str): directory of the cache, defaults to self.cache_dir
+        Returns:
+            names (list of str) and weights (np.array): (region, y, x) fraction
+            of each coarse cell inside each region
+        """
+        cache_dir = self.cache_dir if cache_dir is None else cache_dir
+        shape = tuple(int(n) for n in shape)
+        key = self.files_key("region_weights", shape)
+        file = os.path.join(cache_dir, "region_weights_" + key[:16] + ".npz")
+        if os.path.exists(file):
+            with np.load(file) as npz:
+                if str(npz["key"]) == key:
+                    return [str(name) for name in npz["names"]], npz["weights"]
+
+        _, _, masks = self.bisicles_masks()
+        names = sorted(masks)
+        weights = np.stack([self.coarsen(masks[name], shape) for name in names])
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = file + "." + str(os.getpid()) + ".tmp.npz"
+            np.savez_compressed(
+                tmp_file, names=np.array(names), weights=weights, key=np.array(key)
+            )
+            os.replace(tmp_file, file)
+        except OSError:
+            # Read-only cache directory, the weights are computed every time
+            pass
+        return names, weights
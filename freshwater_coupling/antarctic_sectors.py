@@ -1,14 +1,217 @@
 """
 This module contains classes for different types of Antarctic Sectors
 
-Classes: LevermannSectors
+Classes: SectorSet, LevermannSectors
 """
 
 import os
+import json
+import hashlib
+import subprocess
 import numpy as np
 import xarray as xr
+from freshwater_coupling import instrumentation as IN
 from freshwater_coupling.amr_tools import Masks as bisi_masks
 
+# Sector set definitions shipped with the package
+SECTOR_SET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sector_sets")
+
+
+class SectorSet:
+    """Class for a set of ocean sectors defined in a json file
+    ...
+
+    Each sector has a shelf base depth, optionally a baseline temperature,
+    and a list of boxes [lat_min, lat_max, lon_min, lon_max] (exclusive
+    bounds, no longitude wrap-around) and/or polygons of [lon, lat] vertices.
+    A cell is in a sector if it is in any of its shapes.
+
+    Attributes
+    ----------
+    name (str): name of the sector set
+    sectors (list): list of sector names (str)
+    shelf_depth (dict): shelf base depth of each sector
+    baseline (dict): baseline temperature of each sector that has one
+    shapes (dict): list of boxes and polygons of each sector
+    label_order (list): sectors in order of precedence where the BISICLES
+        masks overlap
+    key (str): hash of the definition and the order of its sectors
+
+    Methods
+    -------
+    load
+        Read a sector set from the package or a json file
+    bounds
+        Shapes of all sectors, keyed on shape name
+    box_mask
+        Mask of the cells inside a lat/lon box
+    polygon_mask
+        Mask of the cells inside a lon/lat polygon
+    rasterize
+        Stack of the masks of all sectors on a grid
+    masks
+        Masks of all sectors on the grid of a dataset, cached on disk
+    """
+
+    def __init__(self, definition):
+        self.name = definition["name"]
+        self.sectors = list(definition["sectors"])
+        self.shelf_depth = {
+            name: sector["shelf_depth"] for name, sector in definition["sectors"].items()
+        }
+        self.baseline = {
+            name: sector["baseline"]
+            for name, sector in definition["sectors"].items()
+            if "baseline" in sector
+        }
+        self.shapes = {
+            name: [("box", box) for box in sector.get("boxes", [])]
+            + [("polygon", polygon) for polygon in sector.get("polygons", [])]
+            for name, sector in definition["sectors"].items()
+        }
+        self.label_order = list(definition.get("label_order", self.sectors))
+        # json.dumps sorts the sectors, their order is hashed separately
+        self.key = hashlib.sha256(
+            (json.dumps(definition, sort_keys=True) + repr(self.sectors)).encode()
+        ).hexdigest()
+        assert len(self.sectors) != 0, "sector set has no sectors"
+
+    @classmethod
+    def load(cls, name="levermann"):
+        """Read a sector set from the package or a json file
+        Args:
+            name (str): name of a set in freshwater_coupling/sector_sets, or
+            path to a json file
+        Returns:
+            SectorSet
+        """
+        file = name
+        if not os.path.exists(file):
+            file = os.path.join(SECTOR_SET_DIR, name + ".json")
+        with open(file) as definition:
+            return cls(json.load(definition))
+
+    def bounds(self):
+        """Shapes of all sectors, keyed on the sector name, numbered from 1
+        for sectors made of several shapes
+        Returns:
+            bounds (dict): coordinates of each shape
+        """
+        bounds = {}
+        for name, shapes in self.shapes.items():
+            for k, (_, coords) in enumerate(shapes):
+                bounds[name + str(k + 1) if len(shapes) > 1 else name] = coords
+        return bounds
+
+    @staticmethod
+    def box_mask(lat, lon, box):
+        """Mask of the cells inside a lat/lon box
+        Args:
+            lat, lon (np.array): co-ordinates of the grid
+            box (list): lat_min, lat_max, lon_min, lon_max, exclusive
+        Returns:
+            mask (np.array): True inside the box
+        """
+        return (lat > box[0]) & (lat < box[1]) & (lon > box[2]) & (lon < box[3])
+
+    @staticmethod
+    def polygon_mask(lat, lon, polygon):
+        """Mask of the cells inside a polygon, by the even-odd rule. Edges
+        take the short way round in longitude, so polygons may cross any
+        meridian, and a polygon going once round the globe is closed over
+        the nearest pole
+        Args:
+            lat, lon (np.array): co-ordinates of the grid
+            polygon (list): [lon, lat] vertices
+        Returns:
+            mask (np.array): True inside the polygon
+        """
+        vertices = np.asarray(polygon, dtype=float)
+        poly_lat = vertices[:, 1]
+        steps = (np.diff(vertices[:, 0]) + 180) % 360 - 180
+        poly_lon = vertices[0, 0] + np.concatenate([[0], np.cumsum(steps)])
+        end_lon = poly_lon[-1] + (vertices[0, 0] - poly_lon[-1] + 180) % 360 - 180
+        if abs(end_lon - poly_lon[0]) > 180:
+            # Close a polygon round the globe along the nearest pole
+            pole = 90.0 if poly_lat.mean() > 0 else -90.0
+            poly_lon = np.concatenate([poly_lon, [end_lon, end_lon, poly_lon[0]]])
+            poly_lat = np.concatenate([poly_lat, [poly_lat[0], pole, pole]])
+
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        mask = np.zeros(lat.shape, dtype=bool)
+        lon_min = poly_lon.min()
+        candidates = np.flatnonzero(
+            (lat >= poly_lat.min()) & (lat <= poly_lat.max())
+        )
+        point_lat = lat.ravel()[candidates]
+        # Longitude of each point in the 360 degrees starting at the polygon
+        point_lon = lon_min + (lon.ravel()[candidates] - lon_min) % 360
+        inside = np.zeros(candidates.size, dtype=bool)
+        for k in range(poly_lon.size):
+            lon_1, lat_1 = poly_lon[k - 1], poly_lat[k - 1]
+            lon_2, lat_2 = poly_lon[k], poly_lat[k]
+            if lat_1 == lat_2:
+                continue
+            crosses = (lat_1 > point_lat) != (lat_2 > point_lat)
+            lon_cross = lon_1 + (point_lat - lat_1) * (lon_2 - lon_1) / (lat_2 - lat_1)
+            inside ^= crosses & (point_lon < lon_cross)
+        mask.ravel()[candidates] = inside
+        return mask
+
+    def rasterize(self, lat, lon):
+        """Stack of the masks of all sectors on a grid
+        Args:
+            lat, lon (np.array): co-ordinates of the grid
+        Returns:
+            masks (np.array): (sector, ...) True inside each sector
+        """
+        lat = np.asarray(lat)
+        lon = np.asarray(lon)
+        masks = np.zeros((len(self.sectors),) + lat.shape, dtype=bool)
+        for k, name in enumerate(self.sectors):
+            for kind, coords in self.shapes[name]:
+                if kind == "box":
+                    masks[k] |= self.box_mask(lat, lon, coords)
+                else:
+                    masks[k] |= self.polygon_mask(lat, lon, coords)
+        return masks
+
+    def masks(self, thetao_ds, cache_dir=None):
+        """Masks of all sectors on the grid of a dataset. With a cache
+        directory they are rasterized once per grid and sector set
+        Args:
+            thetao_ds (xarray dataset): dataset with latitude and longitude
+            cache_dir (str): directory of the mask cache, no caching if None
+        Returns:
+            masks (dict): mask (xarray dataarray) of each sector
+        """
+        lat = thetao_ds.coords["latitude"]
+        lon = thetao_ds.coords["longitude"]
+        if cache_dir is None:
+            stack = self.rasterize(lat.values, lon.values)
+        else:
+            digest = hashlib.sha256(self.key.encode())
+            for arr in (lat, lon):
+                digest.update(np.ascontiguousarray(arr.values, dtype=float).tobytes())
+            key = digest.hexdigest()
+            file = os.path.join(cache_dir, "sector_masks_" + key[:16] + ".npz")
+            stack = None
+            if os.path.exists(file):
+                with np.load(file) as npz:
+                    if str(npz["key"]) == key:
+                        stack = npz["masks"].astype(bool)
+            if stack is None:
+                stack = self.rasterize(lat.values, lon.values)
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_file = file + "." + str(os.getpid()) + ".tmp.npz"
+                np.savez_compressed(tmp_file, masks=stack, key=np.array(key))
+                os.replace(tmp_file, file)
+        return {
+            name: xr.DataArray(stack[k], dims=lat.dims, coords=lat.coords)
+            for k, name in enumerate(self.sectors)
+        }
+
 
 class LevermannSectors:
     """Class for Levermann region related calculations
@@ -16,32 +219,39 @@ class LevermannSectors:
 
     Attributes
     ----------
-    eais1, eais2 (list): coordinates for east antarctica
-    wedd (list): coordinates for weddel
-    amun (list): coordinates for amundsen
-    ross (list): coordinates for ross
-    apen1,apen2 (list): corrdinates for antarctic peninsula
-    sectors (list): list of region names (str)
-    find_shelf_depth (dict): dictionary containing shelfbase depth for each region
-    ds (xarray dataset): xarray dataset of ocean temperature
+    sector_set (SectorSet): sector definitions, the Levermann sectors by
+        default
+    label_order (list): regions in order of precedence where masks overlap
 
     Methods
     -------
+    sector_bounds
+        collect coordinates of all boxes
     create_mask
         creates mask based on coordinates
     sector_masks
         create dictionary of masks
-    sector_sel
-        select a region
+    map2amr
+        Map basal melt values to the BISICLES regions and create amr file
+    write_amr
+        Write fields on the BISICLES grid to netcdf and amr file
     """
 
-    eais1 = [-76, -65, 0, 173]
-    eais2 = [-76, -65, 350, 0]
-    wedd = [-90, -72, 295, 350]
-    amun = [-90, -70, 210, 295]
-    ross = [-90, -76, 150, 210]
-    apen1 = [-70, -65, 294, 310]
-    apen2 = [-75, -70, 285, 295]
+    default_set = SectorSet.load("levermann")
+
+    # Later regions overwrite earlier ones where the BISICLES masks overlap
+    label_order = default_set.label_order
+
+    def __init__(self, sector_set=None):
+        self.sector_set = self.default_set if sector_set is None else sector_set
+        self.label_order = self.sector_set.label_order
+
+    def sector_bounds(self):
+        """collect coordinates of all boxes
+        Returns:
+            bounds (dict): coordinates of each box, keyed on box name
+        """
+        return self.sector_set.bounds()
 
     def create_mask(self, thetao_ds, coords):
         """create a mask based on coordinates
@@ -51,73 +261,72 @@ class LevermannSectors:
         Returns:
             mask (item): mask of sector
         """
-
-        lat = "latitude"
-        lon = "longitude"
-
-        mask = (
-            (thetao_ds.coords[lat] > coords[0])
-            & (thetao_ds.coords[lat] < coords[1])
-            & (thetao_ds.coords[lon] > coords[2])
-            & (thetao_ds.coords[lon] < coords[3])
+        return SectorSet.box_mask(
+            thetao_ds.coords["latitude"], thetao_ds.coords["longitude"], coords
         )
-        return mask
 
-    def sector_masks(self, thetao_ds):
+    def sector_masks(self, thetao_ds, cache_dir=None):
         """select mask of sector
         Args:
             thetao_ds (xarray dataset): thetao dataset
-            sector (str): sector name
+            cache_dir (str): directory of the mask cache, no caching if None
         Returns:
-            mask (item): mask of sector
+            masks (dict): mask of each sector
         """
-
-        mask_eais = self.create_mask(thetao_ds, self.eais1) + self.create_mask(
-            thetao_ds, self.eais2
-        )
-        mask_wedd = self.create_mask(thetao_ds, self.wedd)
-        mask_amun = self.create_mask(thetao_ds, self.amun)
-        mask_ross = self.create_mask(thetao_ds, self.ross)
-        mask_apen = self.create_mask(thetao_ds, self.apen1) + self.create_mask(
-            thetao_ds, self.apen2
-        )
-        masks = {
-            "eais": mask_eais,
-            "wedd": mask_wedd,
-            "amun": mask_amun,
-            "ross": mask_ross,
-            "apen": mask_apen,
-        }
-
-        assert len(masks) == 5, "There should be 5 regions"
-
+        masks = self.sector_set.masks(thetao_ds, cache_dir)
+        assert len(masks) != 0, "There should be at least one region"
         return masks
 
-    def map2amr(self, mask_path, nc_out, driver, name, basalmelt_df):
-        """Map basal melt values to corresponding masks and create amr file
+    def map2amr(self, mask_path, nc_out, driver, name, basalmelt_df, cache_dir=None):
+        """Map basal melt values to corresponding masks and create amr file.
+        A single row is written as variable bm, several rows are written as
+        variables bm_<index> of one netcdf and converted in one nc2amr call
         Args:
             mask_path (str): path to mask files
             nc_out (str): path to output netcdf
+            driver (str): path to nc2amr driver
             name (str): name of output netcdf
             df (pandas dataframe): dataframe of basal melt values
+            cache_dir (str): directory of the mask caches, defaults to mask_path
         Returns:
             Netcdf and amr file with basal melt mapped for each Levermann region
         """
 
-        x, y, bisicles_masks = bisi_masks(mask_path).bisicles_masks()
+        with IN.stage("label_map"):
+            x, y, label = bisi_masks(mask_path, cache_dir).label_map(self.label_order)
 
-        for i, row in basalmelt_df.iterrows():
-            new_mask = np.where(
-                bisicles_masks["apen"] == 1, row.apen, bisicles_masks["apen"]
-            )
-            new_mask = np.where(bisicles_masks["amun"] == 1, row.amun, new_mask)
-            new_mask = np.where(bisicles_masks["ross"] == 1, row.ross, new_mask)
-            new_mask = np.where(bisicles_masks["eais"] == 1, row.eais, new_mask)
-            new_mask = np.where(bisicles_masks["wedd"] == 1, row.wedd, new_mask)
-            basal_da = xr.DataArray(
-                data=new_mask, coords=[("x", x), ("y", y)], name="bm"
-            )
-            basal_da.to_netcdf(nc_out + name + ".nc")
-            os.system(
-                driver + " " + nc_out + name + ".nc " + nc_out + name + ".2d.hdf5 bm"
+        # Label 0 is outside all regions, label k + 1 is label_order[k]
+        values = np.zeros((len(basalmelt_df), len(self.label_order) + 1))
+        values[:, 1:] = basalmelt_df[self.label_order].values
+        basal_melt = values[:, label]
+
+        if len(basalmelt_df) == 1:
+            var_names = ["bm"]
+        else:
+            var_names = ["bm_" + str(index) for index in basalmelt_df.index]
+        self.write_amr(nc_out, driver, name, x, y, dict(zip(var_names, basal_melt)))
+
+    def write_amr(self, nc_out, driver, name, x, y, fields):
+        """Write fields on the BISICLES grid to netcdf and convert them to
+        one amr file
+        Args:
+            nc_out (str): path to output netcdf
+            driver (str): path to nc2amr driver
+            name (str): name of output netcdf
+            x, y (np.array): co-ordinates of the BISICLES grid
+            fields (dict): (y, x) field (np.array) of each variable name
+        Returns:
+            Netcdf and amr file with the fields
+        """
+        basal_ds = xr.Dataset(
+            {var: (("y", "x"), field) for var, field in fields.items()},
+            coords={"x": x, "y": y},
+        )
+        with IN.stage("write_nc"):
+            basal_ds.to_netcdf(nc_out + name + ".nc")
+        with IN.stage("nc2amr", tool=True):
+            subprocess.run(
+                [driver, nc_out + name + ".nc", nc_out + name + ".2d.hdf5"]
+                + list(fields),
+                check=True,
             )
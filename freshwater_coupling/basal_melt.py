@@ -4,10 +4,17 @@ ocean temperature from EC-Earth.
 Classes: OceanData, BasalMelt
 """
 
+import hashlib
+from glob import glob
 import numpy as np
 import xarray as xr
 import pandas as pd
+from freshwater_coupling import instrumentation as IN
+from freshwater_coupling.amr_tools import Masks as bisi_masks
 from freshwater_coupling.antarctic_sectors import LevermannSectors as levermann
+from freshwater_coupling.antarctic_sectors import SectorSet
+from freshwater_coupling.melt_field import OceanIceInterpolator, polar_stereographic
+from freshwater_coupling.sector_operator import SectorOperator
 
 
 class OceanData:
@@ -16,19 +23,35 @@ class OceanData:
 
     Attributes
     ----------
+    sector_set (SectorSet): sector definitions, the Levermann sectors unless
+        another set is given by name or json file
+    sectors (list): sector names of the sector set
+    find_shelf_depth (dict): shelf base depth of each sector
     thetao (str): name of ocean temperature file
     area (str): name of areacello file
+    cache_dir (str): directory of the sector operator and mask caches, no
+        caching if None
+    chunks (dict): dask chunks used to open the ocean temperature file, eager
+        reading if None
+    slab (tuple): sector operator restricted to its hyperslab, with the layer
+        and row slices, built once per instance
+    checkpoints (CheckpointCache): cache of sector means, no checkpoints if None
+    client (dask.distributed Client): cluster for the distributed mode, the
+        sector means are computed in this process if None
+    dask_chunks (dict): chunks of the thetao hyperslab in the distributed mode
+    interpolator (OceanIceInterpolator): interpolation of ocean columns to the
+        BISICLES grid, built once per instance
+    pole_position (tuple): (x, y) of the south pole in the co-ordinates of the
+        BISICLES masks, the centre of the mask domain if None
 
     Methods
     -------
     area_weighted_mean
         Compute area weighted mean of ocean temperature over a sector
-    nearest_mask
-        Mask the values outside of target depth
-    nearest_above
-        Find nearest value above target value
-    nearest_below
-        Find nearest value below target value
+    depth_index
+        Find the layers covering depth ranges in one search
+    depth_weights
+        Compute (range, lev) layer thickness weights of many depth ranges
     lev_weighted_mean
         Compute depth weighted mean oceanic temperature over specific
         oceanic sector and specific depth layers
@@ -40,19 +63,75 @@ class OceanData:
         Compute mean of depth bounds
     select_area_mean
         Compute area mean of sector
+    sector_area_weights
+        Stack sector masks into one (sector, j, i) area weight tensor
+    sector_lev_weights
+        Compute (sector, lev) layer thickness weights
+    sector_operator
+        Build or load the combined sector weight operator
+    slab_operator
+        Sector operator restricted to the layers and rows it needs
+    prepare_operator
+        Build the sector operator from the grid of a thetao file
+    sector_weighted_means
+        Compute volume weighted mean of all sectors in one contraction
     weighted_mean_df
         Compute volume weighted mean for one year of thetao
+    checkpointed_mean_df
+        Volume weighted mean for one year of thetao, reused from checkpoints
+    time_mean
+        Time mean of a block of ocean temperature
+    distributed_means
+        Compute volume weighted means of all sectors on a dask cluster
+    open_thetao
+        Open ocean temperature file with grid dimensions renamed
+    yearly_mean_df
+        Compute volume weighted mean for every year of one or more thetao files
+    ocean_ice_interpolator
+        Build or load the interpolation of ocean columns to the BISICLES grid
     """
 
+    # Sector definitions, see freshwater_coupling/sector_sets
+    sector_set = levermann.default_set
+
     # Sectors
-    sectors = ["eais", "wedd", "amun", "ross", "apen"]
+    sectors = sector_set.sectors
 
     # Sector-specific depths (based on shelf base depth)
-    find_shelf_depth = {"eais": 369, "wedd": 420, "amun": 305, "ross": 312, "apen": 420}
+    find_shelf_depth = sector_set.shelf_depth
+
+    # BISICLES domains are centred on the pole, whether their co-ordinates
+    # count from the domain corner or from the pole
+    pole_position = None
+
+    # Whole time series per chunk, so the time mean of each cell is the same
+    # reduction as in the eager path
+    dask_chunks = {"time_counter": -1, "lev": 1, "j": 128, "i": -1}
+
+    # NEMO output names mapped to the names used by the sector calculations
+    thetao_names = {
+        "y": "j",
+        "x": "i",
+        "nav_lon": "longitude",
+        "nav_lat": "latitude",
+        "olevel": "lev",
+    }
 
-    def __init__(self, thetao, area):
+    def __init__(self, thetao, area, cache_dir=None, chunks=None, sector_set=None):
+        if sector_set is not None:
+            if isinstance(sector_set, str):
+                sector_set = SectorSet.load(sector_set)
+            self.sector_set = sector_set
+            self.sectors = sector_set.sectors
+            self.find_shelf_depth = sector_set.shelf_depth
         self.thetao = thetao
         self.area = area
+        self.cache_dir = cache_dir
+        self.chunks = chunks
+        self.slab = None
+        self.checkpoints = None
+        self.client = None
+        self.interpolator = None
 
     def open_datasets(self):
         """Open datasets
@@ -62,7 +141,10 @@ class OceanData:
         Returns:
             xarray datasets of ocean temperature and area dataset
         """
-        thetao_ds = xr.open_dataset(self.thetao)
+        if self.chunks is None:
+            thetao_ds = xr.open_dataset(self.thetao)
+        else:
+            thetao_ds = xr.open_dataset(self.thetao, chunks=self.chunks)
         area_ds = xr.open_dataset(self.area)
         return thetao_ds, area_ds
 
@@ -84,44 +166,49 @@ class OceanData:
 
         return area_weighted_mean
 
-    def nearest_mask(self, diff):
-        """Mask the values outside of target
+    @staticmethod
+    def depth_index(lev_bnds, tops, bottoms):
+        """Find the layers covering depth ranges, for all ranges in one
+        search over the layer bounds. Ranges above the first or below the
+        last layer are clamped to the layers of the grid
         Args:
-            diff (xarray dataset):
+            lev_bnds (xarray dataarray): (lev, 2) ocean depth bands array,
+            increasing with depth
+            tops, bottoms (np.array): upper and lower depth of each range
         Returns:
-            masked_diff (xarray dataset):
+            top_idx, bottom_idx (np.array): index of the last layer starting
+            above top and of the first layer ending below bottom
         """
-        mask = np.ma.less_equal(diff, 0)
-        if np.all(mask):
-            return None
-        masked_diff = np.ma.masked_array(diff, mask)
-        return masked_diff
-
-    def nearest_above(self, my_array, target):
-        """Find nearest value in array that is greater than target value
-        and return corresponding index
+        lev_bnds = np.asarray(lev_bnds)
+        n_lev = lev_bnds.shape[0]
+        top_idx = np.searchsorted(lev_bnds[:, 0], tops, side="left") - 1
+        bottom_idx = np.searchsorted(lev_bnds[:, 1], bottoms, side="right")
+        return np.clip(top_idx, 0, n_lev - 1), np.clip(bottom_idx, 0, n_lev - 1)
+
+    def depth_weights(self, lev_bnds, tops, bottoms):
+        """Compute layer thickness weights of many depth ranges at once,
+        correcting for layers that fall only partly within a range
         Args:
-            my_array (xarray dataset): ocean data array
-            target (float): depth to calculate around
-        Returns:
-            masked_diff.argmin() ():
-        """
-        diff = my_array - target
-        masked_diff = self.nearest_mask(diff)
-        return masked_diff.argmin()
-
-    def nearest_below(self, my_array, target):
-        """Find nearest value in array that is smaller than target value
-        and return corresponding index
-            Args:
-            my_array (xarray dataset): ocean data array
-            target (float): depth to calculate around
+            lev_bnds (xarray dataarray): (lev, 2) ocean depth bands array
+            tops, bottoms (np.array): upper and lower depth of each range
         Returns:
-            masked_diff.argmin() ():
+            lev_weights (np.array): (range, lev) thickness of each layer within
+            the depth range, zero outside of it
         """
-        diff = target - my_array
-        masked_diff = self.nearest_mask(diff)
-        return masked_diff.argmin()
+        tops = np.asarray(tops)
+        bottoms = np.asarray(bottoms)
+        top_idx, bottom_idx = self.depth_index(lev_bnds, tops, bottoms)
+        lev_bnds = np.asarray(lev_bnds)
+        # Clip in the precision of the bounds, as the thickness always was
+        lev_bnds_sel = np.clip(
+            lev_bnds[None, :, :], tops[:, None, None], bottoms[:, None, None]
+        ).astype(lev_bnds.dtype)
+        levs = np.arange(lev_bnds.shape[0])
+        in_range = (levs >= top_idx[:, None]) & (levs <= bottom_idx[:, None])
+        lev_weights = np.where(
+            in_range, lev_bnds_sel[:, :, 1] - lev_bnds_sel[:, :, 0], 0
+        ).astype(float)
+        return np.nan_to_num(lev_weights)
 
     def lev_weighted_mean(self, thetao_ds, lev_bnds, top, bottom):
         """Compute volume or depth weighted mean oceanic temperature over specific oceanic
@@ -136,12 +223,13 @@ class OceanData:
 
         # Find oceanic layers covering the depth bounds and take a slice of these
         # layers
-        lev_ind_bottom = self.nearest_above(lev_bnds[:, 1], bottom)
-        lev_ind_top = self.nearest_below(lev_bnds[:, 0], top)
+        top_idx, bottom_idx = self.depth_index(lev_bnds, [top], [bottom])
+        lev_ind_top = int(top_idx[0])
+        lev_ind_bottom = int(bottom_idx[0])
         levs_slice = thetao_ds.isel(lev=slice(lev_ind_top, lev_ind_bottom + 1))
         # Create weights for each oceanic layer, correcting for layers
         # that fall only partly within specified depth range
-        lev_bnds_sel = lev_bnds.values[lev_ind_top : lev_ind_bottom + 1]
+        lev_bnds_sel = np.array(lev_bnds.values[lev_ind_top : lev_ind_bottom + 1])
         lev_bnds_sel[lev_bnds_sel > bottom] = bottom
         lev_bnds_sel[lev_bnds_sel < top] = top
         # Weight equals thickness of each layer
@@ -193,49 +281,351 @@ class OceanData:
         lev_weighted_mean = self.lev_weighted_mean(thetao_ds, lev_bnds, top, bottom)
         return lev_weighted_mean
 
-    def weighted_mean_df(self):
+    def sector_area_weights(self, area_ds):
+        """Stack sector masks into one area weight tensor
+        Args:
+            area_ds (xarray dataset): areacello dataset
+        Returns:
+            sector_weights (xarray dataarray): (sector, j, i) area weights,
+            zero outside of each sector
+        """
+        masks = levermann(self.sector_set).sector_masks(area_ds, self.cache_dir)
+        area_weights = area_ds.areacello.fillna(0)
+        sector_mask = xr.concat([masks[sector] for sector in self.sectors], dim="sector")
+        sector_mask = sector_mask.assign_coords(sector=self.sectors)
+        sector_weights = sector_mask * area_weights
+        return sector_weights.transpose("sector", "j", "i")
+
+    def sector_lev_weights(self, lev_bnds):
+        """Compute layer thickness weights of the shelf depth range of each sector
+        Args:
+            lev_bnds (xarray dataarray): ocean depth bands array
+        Returns:
+            lev_weights (np.array): (sector, lev) thickness of each layer within
+            the depth range of the sector, zero outside of it
+        """
+        depth_ranges = np.array(
+            [self.select_depth_range(sector) for sector in self.sectors]
+        )
+        return self.depth_weights(lev_bnds, depth_ranges[:, 0], depth_ranges[:, 1])
+
+    def sector_operator(self, area_ds, lev_bnds):
+        """Build the combined sector weight operator, or load it from the cache
+        when the grid, sector bounds and shelf depths are unchanged
+        Args:
+            area_ds (xarray dataset): areacello dataset
+            lev_bnds (xarray dataarray): ocean depth bands array
+        Returns:
+            operator (SectorOperator): combined area and layer weights
+        """
+
+        def build():
+            sector_weights = self.sector_area_weights(area_ds)
+            lev_weights = self.sector_lev_weights(lev_bnds)
+            return SectorOperator.from_arrays(
+                self.sectors, sector_weights.values, lev_weights
+            )
+
+        if self.cache_dir is None:
+            return build()
+        key = SectorOperator.grid_key(
+            area_ds,
+            lev_bnds,
+            self.sector_set.bounds(),
+            self.find_shelf_depth,
+            self.sectors,
+        )
+        return SectorOperator.cached(self.cache_dir, key, build)
+
+    def slab_operator(self, area_ds, lev_bnds):
+        """Sector operator restricted to the layers and rows it needs. It is
+        built on first use and reused by later calls on this instance
+        Args:
+            area_ds (xarray dataset): areacello dataset
+            lev_bnds (xarray dataarray): ocean depth bands array
+        Returns:
+            operator (SectorOperator), lev_slice (slice) and j_slice (slice)
+        """
+        if self.slab is None:
+            operator = self.sector_operator(area_ds, lev_bnds)
+            lev_slice, j_slice = operator.hyperslab()
+            self.slab = (operator.restrict(lev_slice, j_slice), lev_slice, j_slice)
+        return self.slab
+
+    def prepare_operator(self, file=None):
+        """Build the sector operator from the grid of a thetao file, so later
+        calls on this instance only need to read ocean temperature
+        Args:
+            file (str): thetao file, defaults to the thetao file of this instance
+        Returns:
+            operator (SectorOperator), lev_slice (slice) and j_slice (slice)
+        """
+        thetao_ds = self.open_thetao(file or self.thetao)
+        area_ds = xr.open_dataset(self.area)
+        slab = self.slab_operator(area_ds, thetao_ds["olevel_bounds"])
+        thetao_ds.close()
+        area_ds.close()
+        return slab
+
+    def sector_weighted_means(self, thetao, sector_weights, lev_weights):
+        """Compute volume weighted mean ocean temperature of all sectors in one
+        contraction over the horizontal grid
+        Args:
+            thetao (xarray dataarray): (lev, j, i) annual mean ocean temperature
+            sector_weights (xarray dataarray): (sector, j, i) area weights
+            lev_weights (np.array): (sector, lev) layer thickness weights
+        Returns:
+            vwm (np.array): volume weighted mean ocean temperature of each sector
+        """
+        operator = SectorOperator.from_arrays(
+            self.sectors, sector_weights.values, lev_weights
+        )
+        return operator.apply(thetao.transpose("lev", "j", "i").values)
+
+    @staticmethod
+    def time_mean(thetao):
+        """Time mean of a block of ocean temperature, with the reduction used
+        for the annual mean in weighted_mean_df
+        Args:
+            thetao (np.array): (time_counter, ...) ocean temperature
+        Returns:
+            mean (np.array): (...) time mean
+        """
+        dims = ["time_counter"] + ["dim_" + str(k) for k in range(1, thetao.ndim)]
+        return xr.DataArray(thetao, dims=dims).mean("time_counter").values
+
+    def distributed_means(self, thetao, operator, lev_slice, j_slice):
+        """Compute volume weighted means of all sectors on the dask cluster of
+        this instance. Workers read the hyperslab in chunks, so memory stays
+        bounded for any grid size. The time mean and the area means of each
+        layer are the same reductions as in the eager path, so the results
+        match it exactly
+        Args:
+            thetao (xarray dataarray): (time_counter, lev, j, i) ocean temperature
+            operator (SectorOperator): operator restricted to the hyperslab
+            lev_slice, j_slice (slice): ranges of layers and rows of the hyperslab
+        Returns:
+            vwm (np.array): volume weighted mean ocean temperature of each sector
+        """
+        thetao_slab = thetao.isel(lev=lev_slice, j=j_slice).transpose(
+            "time_counter", "lev", "j", "i"
+        )
+        thetao_slab = thetao_slab.chunk(self.dask_chunks).data
+        thetao_year = thetao_slab.map_blocks(
+            self.time_mean, drop_axis=0, dtype=thetao_slab.dtype
+        )
+        # Area means need whole layers of the hyperslab
+        thetao_year = thetao_year.rechunk({1: -1, 2: -1})
+        awm = thetao_year.map_blocks(
+            operator.area_means,
+            drop_axis=[1, 2],
+            new_axis=1,
+            chunks=(thetao_year.chunks[0], (len(operator.sectors),)),
+            dtype=float,
+        )
+        awm = self.client.compute(awm).result()
+        return operator.depth_means(awm.T)
+
+    def weighted_mean_df(self, vectorized=True):
         """Compute volume weighted mean for one year of thetao
         Args:
-            area_file (str): file name for file containing areacello data
-            thetao_file (str): file name for file containing ocean data
-            sectors (list of str): list of sector names
+            vectorized (bool): reduce all sectors in one contraction instead of
+            looping over the sectors, on the dask cluster if client is set
         Returns:
             df (pandas dataframe): dataframe with volume weighted mean for each sector
         """
         # Open thetao dataset
-        thetao_ds, area_ds = self.open_datasets()
-        thetao_ds = thetao_ds.rename(
-            {
-                "y": "j",
-                "x": "i",
-                "nav_lon": "longitude",
-                "nav_lat": "latitude",
-                "olevel": "lev",
-            }
-        )
-        ds_thetao_year = thetao_ds["thetao"].mean("time_counter")  # Compute annual mean
-        ds_lev_bnds = thetao_ds["olevel_bounds"]
-        masks = levermann().sector_masks(area_ds)
-        vwm_vals = []
-        sects = []
-        # Loop over oceanic sectors
-        mean_df = pd.DataFrame()
-        for sector in self.sectors:
-            mask = masks[sector]
-            ds_sel = ds_thetao_year.where(mask)
-            thetao_awm = self.area_weighted_mean(ds_sel, area_ds)
-            thetao_vwm = self.sector_lev_mean(thetao_awm, ds_lev_bnds, sector)
-            vwm = float(thetao_vwm.values)
-            vwm_vals.append(vwm)
-            sects.append(sector)
-
-        ds_thetao_year.close()
+        with IN.stage("open_datasets"):
+            thetao_ds, area_ds = self.open_datasets()
+            thetao_ds = thetao_ds.rename(self.thetao_names)
+            ds_lev_bnds = thetao_ds["olevel_bounds"]
+        sectors = self.sectors
+        if vectorized:
+            with IN.stage("sector_operator"):
+                operator, lev_slice, j_slice = self.slab_operator(area_ds, ds_lev_bnds)
+            sectors = operator.sectors
+            if self.client is not None:
+                with IN.stage("distributed_means"):
+                    vwm_vals = list(
+                        self.distributed_means(
+                            thetao_ds["thetao"], operator, lev_slice, j_slice
+                        )
+                    )
+            else:
+                # Only read the shelf depth layers and rows of the sectors
+                with IN.stage("thetao_mean"):
+                    thetao_slab = thetao_ds["thetao"].isel(lev=lev_slice, j=j_slice)
+                    ds_thetao_year = thetao_slab.mean("time_counter")  # Compute annual mean
+                    thetao_vals = ds_thetao_year.transpose("lev", "j", "i").values
+                with IN.stage("sector_means"):
+                    vwm_vals = list(operator.apply(thetao_vals))
+        else:
+            ds_thetao_year = thetao_ds["thetao"].mean("time_counter")
+            masks = levermann(self.sector_set).sector_masks(area_ds, self.cache_dir)
+            vwm_vals = []
+            # Loop over oceanic sectors
+            for sector in self.sectors:
+                mask = masks[sector]
+                ds_sel = ds_thetao_year.where(mask)
+                thetao_awm = self.area_weighted_mean(ds_sel, area_ds)
+                thetao_vwm = self.sector_lev_mean(thetao_awm, ds_lev_bnds, sector)
+                vwm = float(thetao_vwm.values)
+                vwm_vals.append(vwm)
+
+        thetao_ds.close()
         area_ds.close()
-        mean_df = pd.DataFrame(columns=self.sectors)
-        series = pd.Series(vwm_vals, index=mean_df.columns)
-        mean_df = mean_df.append(series, ignore_index=True)
+        mean_df = pd.DataFrame([vwm_vals], columns=sectors)
         return mean_df
 
+    def checkpointed_mean_df(self):
+        """Volume weighted mean for one year of thetao, reused from the
+        checkpoints if thetao, area, sector bounds and shelf depths are unchanged
+        Returns:
+            df (pandas dataframe): dataframe with volume weighted mean for each sector
+        """
+        if self.checkpoints is None:
+            return self.weighted_mean_df()
+        with IN.stage("checkpoint_key"):
+            key = self.checkpoints.key(
+                [self.thetao, self.area],
+                sectors=self.sectors,
+                sector_bounds=sorted(self.sector_set.bounds().items()),
+                shelf_depth=sorted(self.find_shelf_depth.items()),
+            )
+        return self.checkpoints.cached("thetao", key, self.weighted_mean_df)
+
+    def open_thetao(self, file):
+        """Open ocean temperature file with grid dimensions renamed
+        Args:
+            file (str): path to ocean temperature dataset
+        Returns:
+            xarray dataset of ocean temperature
+        """
+        if self.chunks is None:
+            thetao_ds = xr.open_dataset(file)
+        else:
+            thetao_ds = xr.open_dataset(file, chunks=self.chunks)
+        return thetao_ds.rename(self.thetao_names)
+
+    def yearly_mean_df(self, files=None):
+        """Compute volume weighted mean for every year of one or more thetao files.
+        All files must be on the same grid, the weight operator is built once.
+        Args:
+            files (list of str or str): thetao files or glob pattern, defaults
+            to the thetao file of this instance
+        Returns:
+            df (pandas dataframe): (year x sector) volume weighted means
+        """
+        if files is None:
+            files = [self.thetao]
+        elif isinstance(files, str):
+            files = sorted(glob(files))
+        assert len(files) != 0, "no thetao files found"
+
+        area_ds = xr.open_dataset(self.area)
+        mean_dfs = []
+        for file in files:
+            thetao_ds = self.open_thetao(file)
+            operator, lev_slice, j_slice = self.slab_operator(
+                area_ds, thetao_ds["olevel_bounds"]
+            )
+            thetao_slab = thetao_ds["thetao"].isel(lev=lev_slice, j=j_slice)
+            thetao_years = thetao_slab.groupby("time_counter.year").mean(
+                "time_counter"
+            )
+            vwm = operator.apply(
+                thetao_years.transpose("year", "lev", "j", "i").values
+            )
+            mean_dfs.append(
+                pd.DataFrame(
+                    vwm, index=thetao_years["year"].values, columns=operator.sectors
+                )
+            )
+            thetao_ds.close()
+        area_ds.close()
+
+        mean_df = pd.concat(mean_dfs)
+        mean_df.index.name = "year"
+        return mean_df
+
+    def ocean_ice_interpolator(
+        self, mask_path, area_ds, operator, j_slice, valid, neighbours=4
+    ):
+        """Build the interpolation of the ocean columns of each sector to the
+        BISICLES cells of its region, or load it from the cache when the grid,
+        sectors and masks are unchanged. It is reused by later calls on this
+        instance
+        Args:
+            mask_path (str): path to mask files
+            area_ds (xarray dataset): areacello dataset
+            operator (SectorOperator): operator restricted to the hyperslab
+            j_slice (slice): range of rows of the hyperslab
+            valid (np.array): (sector, j*i) True for the columns with ocean in
+            the depth range of the sector, only these are interpolated from
+            neighbours (int): number of ocean columns averaged per ice cell
+        Returns:
+            x, y co-ordinate np.array of the BISICLES grid and interpolator
+            (OceanIceInterpolator)
+        """
+        masks = bisi_masks(mask_path, self.cache_dir)
+        order = levermann(self.sector_set).label_order
+        with IN.stage("label_map"):
+            x, y, label = masks.label_map(order)
+        if self.pole_position is None:
+            pole_x, pole_y = (x[0] + x[-1]) / 2, (y[0] + y[-1]) / 2
+        else:
+            pole_x, pole_y = self.pole_position
+        files_key = masks.files_key(
+            "ocean_ice", order, neighbours, float(pole_x), float(pole_y)
+        )
+        valid = np.asarray(valid, dtype=bool)
+        valid_key = hashlib.sha256(np.packbits(valid).tobytes()).hexdigest()
+        key = hashlib.sha256(
+            "{}:{}:{}:{}".format(files_key, operator.key, j_slice, valid_key).encode()
+        ).hexdigest()
+        if self.interpolator is not None and self.interpolator.key == key:
+            return x, y, self.interpolator
+
+        def build():
+            ocean_x, ocean_y = polar_stereographic(
+                area_ds.latitude.isel(j=j_slice).values.ravel(),
+                area_ds.longitude.isel(j=j_slice).values.ravel(),
+            )
+            sector_cells = []
+            for name in order:
+                sector = operator.sectors.index(name)
+                cells = operator.sector_cells(name)
+                sector_cells.append((sector, cells[valid[sector, cells]]))
+            # Shift the projected columns into the co-ordinates of the masks
+            ocean_x = ocean_x + pole_x
+            ocean_y = ocean_y + pole_y
+            half_x = abs(x[-1] - x[0]) / (2 * (x.size - 1)) if x.size > 1 else 0
+            half_y = abs(y[-1] - y[0]) / (2 * (y.size - 1)) if y.size > 1 else 0
+            columns = np.concatenate([cells for _, cells in sector_cells])
+            outside = (
+                (ocean_x[columns] < x.min() - half_x)
+                | (ocean_x[columns] > x.max() + half_x)
+                | (ocean_y[columns] < y.min() - half_y)
+                | (ocean_y[columns] > y.max() + half_y)
+            )
+            if outside.any():
+                raise ValueError(
+                    "{} of {} ocean columns of the sectors lie outside the "
+                    "BISICLES domain, check pole_position".format(
+                        outside.sum(), columns.size
+                    )
+                )
+            return OceanIceInterpolator.build(
+                ocean_x, ocean_y, sector_cells, x, y, label, neighbours
+            )
+
+        if self.cache_dir is None:
+            self.interpolator = build()
+            self.interpolator.key = key
+        else:
+            self.interpolator = OceanIceInterpolator.cached(self.cache_dir, key, build)
+        return x, y, self.interpolator
+
 
 class BasalMelt(OceanData):
     """Class for Basal Melt calculation related calculations
@@ -248,8 +638,13 @@ class BasalMelt(OceanData):
     c_po (float): specific heat capacity of ocean mixed layer J kg-1 K-1
     L_i (float): latent heat of fusion of ice
     Tf (float): Freezing temperature
-    baseline (float): baseline climate mean temperature
+    baseline (dict): baseline climate mean temperature of each sector, from
+        the sector set
     gamma (float): gamma value for chosen model
+    gamma_scale (float): scaling of the gamma value of the model
+    anomaly_bounds (tuple): lower and upper bound of realistic anomalies
+    problem_names (tuple): problems of invalid anomalies, indexed by the
+        problem codes of melt_anomalies, "" for a valid anomaly
 
     Methods
     -------
@@ -259,10 +654,24 @@ class BasalMelt(OceanData):
         Calculate basal melt
     BasalMeltAnomalies
         Calculate basal melt anomaly
+    melt_anomalies
+        Calculate and validate basal melt anomalies of whole arrays
+    check_report
+        Raise an error for the problems of a validation report
     thetao2basalmelt
         Calculate basal melt from 3D ocean temperature file
+    thetao2basalmelt_batch
+        Calculate basal melt for every year of one or more thetao files
+    melt_sweep
+        Calculate basal melt for every gamma value, baseline set and year
+    thetao2basalmelt_sweep
+        Calculate basal melt ensemble from one or more thetao files
     mapBasalMelt
         Map basal melt values to Antarctic Sectors
+    thetao2basalmelt_field
+        Calculate basal melt of each ocean column and map it to the BISICLES grid
+    map_basalmelt_field
+        Map the spatially resolved basal melt to a BISICLES amr file
     """
 
     # Parameters to compute basal ice shelf melt (Favier 2019)
@@ -271,53 +680,142 @@ class BasalMelt(OceanData):
     c_po = 3974.0
     L_i = 3.34 * 10**5
     Tf = -1.6
-    baseline = {
-        "eais": 0.27209795341055726,
-        "wedd": -1.471784486780416,
-        "amun": 2.1510233407460326,
-        "ross": 0.5177848939696833,
-        "apen": -0.6192596251283067,
-    }
+    baseline = OceanData.sector_set.baseline
+
 
+    # Scaling of the gamma value of the model
+    gamma_scale = 0.65
 
-    def __init__(self, thetao, area, gamma):
-        OceanData.__init__(self, thetao, area)
-        self.gamma = gamma * 0.65
+    # Realistic basal melt anomalies lie strictly within these bounds
+    anomaly_bounds = (-100, 100)
 
-    def basal_melt_sensitivity(self):
+    # Problems of invalid anomalies, in order of precedence after the valid ""
+    problem_names = ("", "empty sector", "nan", "above upper bound", "below lower bound")
+
+    def __init__(
+        self, thetao, area, gamma, cache_dir=None, chunks=None, sector_set=None
+    ):
+        OceanData.__init__(self, thetao, area, cache_dir, chunks, sector_set)
+        self.baseline = self.sector_set.baseline
+        self.gamma = gamma * self.gamma_scale
+
+    def basal_melt_sensitivity(self, gamma=None):
         """Calculate quadratic constant
+        Args:
+            gamma (float or np.array): scaled gamma value(s), defaults to the
+            gamma of this instance
         Returns:
-            melt_sensitivity (float) quadratic constant value
+            melt_sensitivity (float or np.array) quadratic constant value
         """
+        gamma = self.gamma if gamma is None else gamma
         c_lin = (self.rho_sw * self.c_po) / (self.rho_i * self.L_i)
         c_quad = (c_lin) ** 2
-        melt_sensitivity = self.gamma * 10**5 * c_quad  # Quadratic constant
+        melt_sensitivity = gamma * 10**5 * c_quad  # Quadratic constant
         return melt_sensitivity
 
-    def quadratic_basal_melt(self, thetao):
+    def quadratic_basal_melt(self, thetao, gamma=None):
         """Calculate basal melt
         Args:
             thetao (float): ocean temperature value
+            gamma (float or np.array): scaled gamma value(s), broadcast
+            against thetao, defaults to the gamma of this instance
         Returns:
             bm (float): basal melt value
         """
-        melt_sensitivity = self.basal_melt_sensitivity()
+        melt_sensitivity = self.basal_melt_sensitivity(gamma)
         basalmelt = (thetao - self.Tf) * (abs(thetao - self.Tf)) * melt_sensitivity
         return basalmelt
 
-    def basal_melt_anomalies(self, thetao, base):
-        """Calculate basal melt anomaly
+    def melt_anomalies(self, thetao, base, gamma=None, dims=None, problems=None):
+        """Calculate basal melt anomalies of whole arrays and validate them all,
+        instead of stopping at the first bad value. An anomaly is invalid if
+        it is nan, e.g. for an empty sector, or outside of anomaly_bounds
         Args:
-            thetao (float): ocean temperature value
-            base (float): ocean temperature baseline value
+            thetao (np.array): (..., sector) ocean temperature
+            base (np.array): baseline temperature, broadcast against thetao
+            gamma (float or np.array): scaled gamma value(s), broadcast
+            against thetao, defaults to the gamma of this instance
+            dims (dict): name and labels of each axis of the anomalies, in
+            order, defaults to positions along dim_<k> and sector
+            problems (list of str): problems to report, see problem_names,
+            defaults to all
         Returns:
-            dBM (float) basal melt anomaly
+            delta_basalmelt (np.array) basal melt anomalies, quality
+            (np.array) True where the anomaly is valid and report (pandas
+            dataframe) with the labels, temperature, anomaly and problem of
+            each reported invalid anomaly
         """
-        basalmelt_base = self.quadratic_basal_melt(base)
-        basalmelt = self.quadratic_basal_melt(thetao)
+        thetao = np.asarray(thetao, dtype=float)
+        basalmelt_base = self.quadratic_basal_melt(np.asarray(base, dtype=float), gamma)
+        basalmelt = self.quadratic_basal_melt(thetao, gamma)
         delta_basalmelt = basalmelt - basalmelt_base
-        assert delta_basalmelt < 100, "Basal melt too unrealistic"
-        assert delta_basalmelt > -100, "Basal melt too unrealistic"
+        assert delta_basalmelt.ndim != 0, "anomalies need a sector axis"
+        thetao = np.broadcast_to(thetao, delta_basalmelt.shape)
+
+        lower, upper = self.anomaly_bounds
+        # A sector is empty if it has no temperature at all
+        empty = np.broadcast_to(
+            np.all(np.isnan(thetao.reshape(-1, thetao.shape[-1])), axis=0),
+            thetao.shape,
+        )
+        with np.errstate(invalid="ignore"):
+            codes = np.select(
+                [
+                    empty,
+                    ~np.isfinite(delta_basalmelt),
+                    delta_basalmelt >= upper,
+                    delta_basalmelt <= lower,
+                ],
+                [np.int8(code) for code in range(1, len(self.problem_names))],
+                np.int8(0),
+            )
+        quality = codes == 0
+
+        if problems is None:
+            problems = self.problem_names[1:]
+        reported = [self.problem_names.index(problem) for problem in problems]
+        if dims is None:
+            dims = {
+                "dim_" + str(k): np.arange(n)
+                for k, n in enumerate(delta_basalmelt.shape[:-1])
+            }
+            dims["sector"] = np.arange(delta_basalmelt.shape[-1])
+        bad = np.nonzero(np.isin(codes, reported))
+        report = pd.DataFrame(
+            {name: np.asarray(labels)[idx] for (name, labels), idx in zip(dims.items(), bad)}
+        )
+        report["thetao"] = thetao[bad]
+        report["basal_melt_anomaly"] = delta_basalmelt[bad]
+        report["problem"] = np.array(self.problem_names, dtype=object)[codes[bad]]
+        return delta_basalmelt, quality, report
+
+    def check_report(self, report, problems=None):
+        """Raise an error for the problems of a validation report
+        Args:
+            report (pandas dataframe): report of melt_anomalies
+            problems (list of str): problems to raise for, defaults to all
+        """
+        if problems is not None:
+            report = report[report["problem"].isin(problems)]
+        if len(report) != 0:
+            raise ValueError("Basal melt too unrealistic:\n" + report.to_string(index=False))
+
+    def basal_melt_anomalies(self, thetao, base, gamma=None, dims=None, strict=True):
+        """Calculate basal melt anomaly
+        Args:
+            thetao (np.array): (..., sector) ocean temperature
+            base (np.array): ocean temperature baseline, broadcast against thetao
+            gamma (float or np.array): scaled gamma value(s), defaults to the
+            gamma of this instance
+            dims (dict): name and labels of each axis, used in the error message
+            strict (bool): raise ValueError if any anomaly is invalid, see
+            melt_anomalies for the quality mask and report
+        Returns:
+            dBM (np.array) basal melt anomaly
+        """
+        delta_basalmelt, _, report = self.melt_anomalies(thetao, base, gamma, dims)
+        if strict:
+            self.check_report(report)
         return delta_basalmelt
 
     def thetao2basalmelt(self):
@@ -325,17 +823,103 @@ class BasalMelt(OceanData):
         Returns:
             df2 (pandas dataframe) values of basal melt for each Antarctic region
         """
-        wmean_df = self.weighted_mean_df()
-        basalmelt_df = pd.DataFrame()
-        for column in wmean_df:
-            thetao = wmean_df[column].values
-            base = self.baseline.get(column)
-            delta_basalmelt = self.basal_melt_anomalies(thetao, base)
-            basalmelt_df[column] = -delta_basalmelt
+        wmean_df = self.checkpointed_mean_df()
+        base = np.array([self.baseline.get(column) for column in wmean_df])
+        delta_basalmelt = self.basal_melt_anomalies(
+            wmean_df.values,
+            base,
+            dims={"row": wmean_df.index, "sector": wmean_df.columns},
+        )
+        basalmelt_df = pd.DataFrame(
+            -delta_basalmelt, index=wmean_df.index, columns=wmean_df.columns
+        )
         assert basalmelt_df.empty is False, "Dataframe should not be empty"
         print(basalmelt_df)
         return basalmelt_df
 
+    def thetao2basalmelt_batch(self, files=None):
+        """Calculate basal melt for every year of one or more thetao files
+        Args:
+            files (list of str or str): thetao files or glob pattern
+        Returns:
+            thetao_df (pandas dataframe) and basalmelt_df (pandas dataframe):
+            (year x sector) ocean temperature and basal melt anomalies
+        """
+        thetao_df = self.yearly_mean_df(files)
+        base = np.array([self.baseline.get(column) for column in thetao_df])
+        delta_basalmelt = self.basal_melt_anomalies(
+            thetao_df.values,
+            base,
+            dims={"year": thetao_df.index, "sector": thetao_df.columns},
+        )
+        basalmelt_df = pd.DataFrame(
+            -delta_basalmelt, index=thetao_df.index, columns=thetao_df.columns
+        )
+        return thetao_df, basalmelt_df
+
+    def melt_sweep(self, thetao_df, gammas, baselines=None):
+        """Calculate basal melt anomalies for every combination of gamma value,
+        baseline set and year in one broadcast over a (gamma, baseline, year,
+        sector) array. Invalid anomalies do not stop the sweep, they are
+        listed in the report
+        Args:
+            thetao_df (pandas dataframe): (year x sector) ocean temperature,
+            e.g. from yearly_mean_df or ParallelBasalMelt
+            gammas (list or np.array): gamma values, before scaling
+            baselines (dict or pandas dataframe): baseline temperature of each
+            sector for each baseline set, as {name: {sector: temperature}} or
+            a (name x sector) dataframe, defaults to the class baseline
+        Returns:
+            sweep_df (pandas dataframe): (gamma, baseline, year) x sector basal
+            melt anomalies and report (pandas dataframe): invalid anomalies,
+            see melt_anomalies
+        """
+        if baselines is None:
+            baselines = {"default": self.baseline}
+        if isinstance(baselines, dict):
+            baselines = pd.DataFrame.from_dict(baselines, orient="index")
+        sectors = list(thetao_df.columns)
+        base = baselines[sectors].values.astype(float)
+        gammas = np.asarray(gammas, dtype=float).ravel()
+
+        year = thetao_df.index.name or "year"
+        delta_basalmelt, _, report = self.melt_anomalies(
+            thetao_df.values.astype(float)[None, None, :, :],
+            base[None, :, None, :],
+            (gammas * self.gamma_scale)[:, None, None, None],
+            dims={
+                "gamma": gammas,
+                "baseline": baselines.index,
+                year: thetao_df.index,
+                "sector": sectors,
+            },
+        )
+
+        index = pd.MultiIndex.from_product(
+            [gammas, baselines.index, thetao_df.index],
+            names=["gamma", "baseline", year],
+        )
+        sweep_df = pd.DataFrame(
+            -delta_basalmelt.reshape(-1, len(sectors)), index=index, columns=sectors
+        )
+        return sweep_df, report
+
+    def thetao2basalmelt_sweep(self, gammas, baselines=None, files=None):
+        """Calculate basal melt for every gamma value, baseline set and year of
+        one or more thetao files, reducing ocean temperature only once
+        Args:
+            gammas (list or np.array): gamma values, before scaling
+            baselines (dict or pandas dataframe): baseline sets, see melt_sweep
+            files (list of str or str): thetao files or glob pattern
+        Returns:
+            thetao_df (pandas dataframe): (year x sector) ocean temperature,
+            sweep_df (pandas dataframe): (gamma, baseline, year) x sector basal
+            melt anomalies and report (pandas dataframe): invalid anomalies
+        """
+        thetao_df = self.yearly_mean_df(files)
+        sweep_df, report = self.melt_sweep(thetao_df, gammas, baselines)
+        return thetao_df, sweep_df, report
+
     def map_basalmelt(self, mask_path, nc_out, driver, name):
         """Calculate basal melt values and map to Antarctic sectors
         Args:
@@ -347,5 +931,87 @@ class BasalMelt(OceanData):
             basal melt dataframe and produces netcdf and hdf5 files
         """
         basalmelt_df = self.thetao2basalmelt()
-        levermann().map2amr(mask_path, nc_out, driver, name, basalmelt_df)
+        levermann(self.sector_set).map2amr(
+            mask_path, nc_out, driver, name, basalmelt_df, self.cache_dir
+        )
+        return basalmelt_df
+
+    def thetao2basalmelt_field(self, mask_path, neighbours=4):
+        """Calculate basal melt anomalies of each ocean column of the sectors,
+        from the depth weighted mean temperature of the column over the shelf
+        depth range and the baseline of its sector, and interpolate them to
+        the BISICLES cells of each region
+        Args:
+            mask_path (str): path to mask files
+            neighbours (int): number of ocean columns averaged per ice cell
+        Returns:
+            basalmelt_df (pandas dataframe) of the sector means, x,y
+            co-ordinate np.array and field (np.array) of basal melt on the
+            BISICLES grid, 0 outside all regions
+        """
+        with IN.stage("open_datasets"):
+            thetao_ds, area_ds = self.open_datasets()
+            thetao_ds = thetao_ds.rename(self.thetao_names)
+        with IN.stage("sector_operator"):
+            operator, lev_slice, j_slice = self.slab_operator(
+                area_ds, thetao_ds["olevel_bounds"]
+            )
+        with IN.stage("thetao_mean"):
+            thetao_slab = thetao_ds["thetao"].isel(lev=lev_slice, j=j_slice)
+            thetao_vals = thetao_slab.mean("time_counter").transpose("lev", "j", "i").values
+        with IN.stage("column_melt"):
+            column_thetao = operator.column_means(thetao_vals)
+        # Which columns reach into the depth range is fixed by the grid
+        with IN.stage("ocean_ice_interpolator"):
+            x, y, interpolator = self.ocean_ice_interpolator(
+                mask_path,
+                area_ds,
+                operator,
+                j_slice,
+                np.isfinite(column_thetao),
+                neighbours,
+            )
+        thetao_ds.close()
+        area_ds.close()
+
+        base = np.array([self.baseline.get(sector) for sector in operator.sectors])
+        with IN.stage("column_melt"):
+            # Columns without ocean in the depth range stay nan and are left
+            # out of the interpolation, so only bound problems are reported
+            delta_basalmelt, _, report = self.melt_anomalies(
+                column_thetao.T,
+                base,
+                dims={
+                    "cell": np.arange(column_thetao.shape[1]),
+                    "sector": operator.sectors,
+                },
+                problems=["above upper bound", "below lower bound"],
+            )
+            self.check_report(report)
+            column_melt = -delta_basalmelt.T
+        with IN.stage("interpolate_melt"):
+            field = interpolator.apply(column_melt)
+
+        delta_basalmelt = self.basal_melt_anomalies(
+            operator.apply(thetao_vals), base, dims={"sector": operator.sectors}
+        )
+        basalmelt_df = pd.DataFrame([-delta_basalmelt], columns=operator.sectors)
+        print(basalmelt_df)
+        return basalmelt_df, x, y, field
+
+    def map_basalmelt_field(self, mask_path, nc_out, driver, name, neighbours=4):
+        """Calculate spatially resolved basal melt and map it to a BISICLES
+        amr file, as variable bm
+        Args:
+            mask_path (str): path to mask files
+            nc_out (str): path to where basal melt file will be output
+            driver (str): path to filetools driver
+            name (str): name of basal melt file
+            neighbours (int): number of ocean columns averaged per ice cell
+        Returns:
+            basal melt dataframe of the sector means and produces netcdf and
+            hdf5 files
+        """
+        basalmelt_df, x, y, field = self.thetao2basalmelt_field(mask_path, neighbours)
+        levermann(self.sector_set).write_amr(nc_out, driver, name, x, y, {"bm": field})
         return basalmelt_df
@@ -0,0 +1,326 @@
+"""This module is for waiting on a submitted BISICLES job, either until its
+new plot file has been written or until the job has finished.
+
+Classes: Inotify, BisiclesWaiter
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+from fnmatch import fnmatch
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+
+
+class Inotify:
+    """Minimal inotify watcher on directories, through ctypes
+    ...
+
+    inotify does not see files written from other nodes on most shared
+    filesystems, so it is only used to wake up early, never relied on.
+
+    Attributes
+    ----------
+    paths (list): directories to watch
+    fd (int): inotify file descriptor, None if inotify is not available
+
+    Methods
+    -------
+    read
+        Wait for events and return them
+    close
+        Close the inotify file descriptor
+    """
+
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    event_header = struct.Struct("iIII")
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        for path in paths:
+            if libc.inotify_add_watch(fd, os.fsencode(path), self.mask) < 0:
+                os.close(fd)
+                return
+        self.fd = fd
+
+    def read(self, timeout):
+        """Wait for events and return them
+        Args:
+            timeout (float): maximum time to wait in seconds
+        Returns:
+            events (list): (file name, event mask) of each event
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self.event_header.size <= len(buffer):
+            _, mask, _, length = self.event_header.unpack_from(buffer, offset)
+            offset += self.event_header.size
+            name = buffer[offset : offset + length].rstrip(b"\0").decode()
+            offset += length
+            events.append((name, mask))
+        return events
+
+    def close(self):
+        """Close the inotify file descriptor"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class BisiclesWaiter:
+    """Class for waiting on a BISICLES job
+    ...
+
+    Create the waiter before submitting the job: the error stream left by
+    an earlier job is only scanned once the new job has rewritten it.
+
+    Attributes
+    ----------
+    sentinel (str): file touched by the job when it has finished
+    plot_dir (str): directory of BISICLES plot files
+    exp_name (str): experiment name
+    err_file (str): error stream of the job, checked for srun errors
+    timeout (float): maximum time to wait in seconds, no limit if None
+    min_interval, max_interval (float): range of the adaptive polling interval
+    settle (float): seconds without writes before a closed plot file is used
+    new_plots (int): number of plot files the job writes
+    finished (bool): the sentinel has been seen and removed
+
+    Methods
+    -------
+    plot_pattern
+        Glob pattern of the plot files of the experiment
+    plots
+        Plot files of the experiment with their size
+    err_identity
+        Inode and modification time of the error stream
+    check_errors
+        Check new output in the error stream for srun errors
+    check_sentinel
+        Remove the sentinel if the job has finished
+    wait_plot
+        Wait until the job has finished or its new plot file is written
+    wait_done
+        Wait until the job has finished
+    wait
+        Wait until the job has finished and return its new plot file
+    """
+
+    error_message = "srun: error:"
+
+    def __init__(
+        self,
+        sentinel,
+        plot_dir,
+        exp_name,
+        err_file=None,
+        timeout=None,
+        min_interval=0.5,
+        max_interval=10.0,
+        settle=2.0,
+        new_plots=1,
+    ):
+        self.sentinel = sentinel
+        self.plot_dir = plot_dir
+        self.exp_name = exp_name
+        self.err_file = err_file
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.settle = settle
+        self.new_plots = new_plots
+        self.finished = False
+        self.start = time.time()
+        self.old_plots = self.plots()
+        self.err_offset = 0
+        self.err_stale = self.err_identity()
+
+    def plot_pattern(self):
+        """Glob pattern of the plot files of the experiment
+        Returns:
+            pattern (str)
+        """
+        return "plot." + self.exp_name + ".??????.2d.hdf5"
+
+    def plots(self):
+        """Plot files of the experiment with their size
+        Returns:
+            plots (dict): size of each plot file, keyed on file name
+        """
+        plots = {}
+        for entry in os.scandir(self.plot_dir):
+            if fnmatch(entry.name, self.plot_pattern()):
+                plots[entry.name] = entry.stat().st_size
+        return plots
+
+    def err_identity(self):
+        """Inode and modification time of the error stream
+        Returns:
+            identity (tuple), None if there is no error stream
+        """
+        if self.err_file is None or not os.path.exists(self.err_file):
+            return None
+        stat = os.stat(self.err_file)
+        return stat.st_ino, stat.st_mtime_ns
+
+    def check_errors(self):
+        """Check new output in the error stream for srun errors. The stream
+        left by an earlier job is skipped until the new job rewrites it
+        Raises:
+            RuntimeError if the job reported an srun error
+        """
+        identity = self.err_identity()
+        if identity is None:
+            return
+        if self.err_stale is not None:
+            if identity == self.err_stale:
+                return
+            self.err_stale = None
+            self.err_offset = 0  # rewritten by the new job
+        if os.path.getsize(self.err_file) < self.err_offset:
+            self.err_offset = 0
+        with open(self.err_file, "rb") as err:
+            err.seek(max(self.err_offset - len(self.error_message), 0))
+            new_output = err.read()
+            self.err_offset = err.tell()
+        if self.error_message.encode() in new_output:
+            raise RuntimeError("BISICLES encountered an error, see " + self.err_file)
+
+    def check_sentinel(self):
+        """Remove the sentinel if the job has finished
+        Returns:
+            finished (bool)
+        """
+        if not self.finished and os.path.exists(self.sentinel):
+            os.remove(self.sentinel)
+            self.finished = True
+        return self.finished
+
+    def check_timeout(self):
+        """Raise TimeoutError once timeout seconds have passed"""
+        if self.timeout is not None and time.time() - self.start > self.timeout:
+            raise TimeoutError("BISICLES did not finish in time")
+
+    def watcher(self):
+        """Inotify watcher on the sentinel, plot and error stream directories
+        Returns:
+            Inotify
+        """
+        watch_dirs = {os.path.dirname(os.path.abspath(self.sentinel)), self.plot_dir}
+        if self.err_file is not None:
+            watch_dirs.add(os.path.dirname(os.path.abspath(self.err_file)))
+        return Inotify(sorted(watch_dirs))
+
+    def wait_plot(self):
+        """Wait until the job has finished or its new_plots new plot files are
+        written. The plot directory is polled every interval, and a new plot
+        file counts as written once its size has not changed, and inotify
+        reported no writes to it, for settle seconds. The job may still be
+        running then, see wait_done
+        Returns:
+            plot (str): path of the newest new plot file, None if the job
+            finished without writing one
+        Raises:
+            RuntimeError on an srun error, TimeoutError after timeout
+        """
+        changed = {}  # size and time of the last change of each new plot
+        interval = self.min_interval
+        watcher = self.watcher()
+        try:
+            while True:
+                self.check_errors()
+                if self.check_sentinel():
+                    new_plots = [
+                        name for name in self.plots() if name not in self.old_plots
+                    ]
+                    if new_plots:
+                        return os.path.join(self.plot_dir, max(new_plots))
+                    return None
+                now = time.time()
+                for name, size in self.plots().items():
+                    if name in self.old_plots:
+                        continue
+                    if name not in changed or changed[name][0] != size:
+                        changed[name] = (size, now)
+                settled = [
+                    name
+                    for name, (_, last) in changed.items()
+                    if now - last >= self.settle
+                ]
+                if len(settled) >= self.new_plots:
+                    return os.path.join(self.plot_dir, max(settled))
+
+                self.check_timeout()
+                wait_time = interval
+                if changed:
+                    wait_time = min(interval, self.settle)
+                events = watcher.read(wait_time)
+                for name, _ in events:
+                    if name in changed:
+                        changed[name] = (changed[name][0], time.time())
+                # Poll faster while files are changing, back off while idle
+                if events or len(changed) > len(settled):
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * 1.5, self.max_interval)
+        finally:
+            watcher.close()
+
+    def wait_done(self):
+        """Wait until the job has finished and remove its sentinel, so no
+        sentinel is left behind for a later leg
+        Raises:
+            RuntimeError on an srun error, TimeoutError after timeout
+        """
+        interval = self.min_interval
+        watcher = self.watcher()
+        try:
+            while True:
+                self.check_errors()
+                if self.check_sentinel():
+                    return
+                self.check_timeout()
+                events = watcher.read(interval)
+                if events:
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * 1.5, self.max_interval)
+        finally:
+            watcher.close()
+
+    def wait(self):
+        """Wait until the job has finished and return its new plot file
+        Returns:
+            plot (str): path of the newest new plot file, None if the job
+            finished without writing one
+        Raises:
+            RuntimeError on an srun error, TimeoutError after timeout
+        """
+        plot = self.wait_plot()
+        self.wait_done()
+        return plot
@@ -0,0 +1,169 @@
+"""This module contains the content addressed cache of intermediate
+results of a leg, so a resubmitted leg skips the work that is still valid.
+
+Classes: CheckpointCache
+"""
+
+import os
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+class CheckpointCache:
+    """Class for checkpoints of intermediate tables of an experiment
+    ...
+
+    A checkpoint is stored as <path>/<exp_name>/<kind>_<key>.npz, where the
+    key hashes the path, size and modification time of the input files and
+    the parameters the table depends on. Input files are written once by the
+    models, so a changed file shows as a new size or modification time and
+    the file contents do not have to be read.
+
+    Attributes
+    ----------
+    path (str): checkpoint directory
+    exp_name (str): experiment name
+
+    Methods
+    -------
+    file_key
+        Identify a file by path, size and modification time
+    key
+        Hash input files and parameters
+    file
+        Path of a checkpoint
+    get
+        Read a checkpoint
+    put
+        Write a checkpoint
+    cached
+        Read a checkpoint or compute and store it
+    evict
+        Remove checkpoints of one or all experiments, optionally by age
+    """
+
+    def __init__(self, path, exp_name):
+        self.path = path
+        self.exp_name = exp_name
+
+    @staticmethod
+    def file_key(file):
+        """Identify a file by path, size and modification time
+        Args:
+            file (str): path to file
+        Returns:
+            key (str)
+        """
+        stat = os.stat(file)
+        return "{}:{}:{}".format(os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+
+    def key(self, files, **params):
+        """Hash input files and parameters
+        Args:
+            files (list): paths to the input files
+            params: parameters the checkpoint depends on
+        Returns:
+            key (str): hex digest
+        """
+        digest = hashlib.sha256()
+        for file in files:
+            digest.update(self.file_key(file).encode())
+        digest.update(repr(sorted(params.items())).encode())
+        return digest.hexdigest()
+
+    def file(self, kind, key):
+        """Path of a checkpoint
+        Args:
+            kind (str): name of the intermediate, e.g. thetao
+            key (str): hash of the inputs, see key
+        Returns:
+            file (str)
+        """
+        return os.path.join(self.path, self.exp_name, kind + "_" + key[:32] + ".npz")
+
+    def get(self, kind, key):
+        """Read a checkpoint
+        Args:
+            kind (str): name of the intermediate
+            key (str): hash of the inputs
+        Returns:
+            table_df (pandas dataframe), None if there is no valid checkpoint
+        """
+        file = self.file(kind, key)
+        if not os.path.exists(file):
+            return None
+        with np.load(file) as npz:
+            if str(npz["key"]) != key:
+                return None
+            return pd.DataFrame(
+                npz["values"],
+                index=npz["index"].tolist(),
+                columns=[str(column) for column in npz["columns"]],
+            )
+
+    def put(self, kind, key, table_df):
+        """Write a checkpoint
+        Args:
+            kind (str): name of the intermediate
+            key (str): hash of the inputs
+            table_df (pandas dataframe): table to store
+        """
+        file = self.file(kind, key)
+        index = np.asarray(table_df.index)
+        if index.dtype == object:
+            index = index.astype(str)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp_file = file + "." + str(os.getpid()) + ".tmp.npz"
+        np.savez(
+            tmp_file,
+            values=np.asarray(table_df.values, dtype=float),
+            index=index,
+            columns=np.array(table_df.columns, dtype=str),
+            key=np.array(key),
+        )
+        os.replace(tmp_file, file)
+
+    def cached(self, kind, key, compute):
+        """Read a checkpoint or compute and store it
+        Args:
+            kind (str): name of the intermediate
+            key (str): hash of the inputs
+            compute (callable): function returning the table
+        Returns:
+            table_df (pandas dataframe)
+        """
+        table_df = self.get(kind, key)
+        if table_df is None:
+            table_df = compute()
+            self.put(kind, key, table_df)
+        return table_df
+
+    def evict(self, exp_name=None, max_age=None):
+        """Remove checkpoints of one or all experiments, optionally by age
+        Args:
+            exp_name (str): experiment to evict, all experiments if None
+            max_age (float): only remove checkpoints older than max_age seconds
+        Returns:
+            removed (int): number of removed checkpoints
+        """
+        if not os.path.isdir(self.path):
+            return 0
+        if exp_name is None:
+            exp_dirs = [entry.path for entry in os.scandir(self.path) if entry.is_dir()]
+        else:
+            exp_dirs = [os.path.join(self.path, exp_name)]
+        now = time.time()
+        removed = 0
+        for exp_dir in exp_dirs:
+            if not os.path.isdir(exp_dir):
+                continue
+            for entry in os.scandir(exp_dir):
+                if not entry.name.endswith(".npz"):
+                    continue
+                if max_age is not None and now - entry.stat().st_mtime < max_age:
+                    continue
+                os.remove(entry.path)
+                removed += 1
+        return removed
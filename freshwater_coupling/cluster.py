@@ -0,0 +1,38 @@
+"""This module starts a dask.distributed cluster on the local node, for
+reducing ocean temperature of high resolution grids in bounded memory.
+
+Functions: local_client
+"""
+
+import os
+
+try:
+    from distributed import Client, LocalCluster
+except ImportError:  # only needed for the distributed mode
+    Client = None
+    LocalCluster = None
+
+
+def local_client(n_workers=None, threads_per_worker=1, memory_fraction=0.8):
+    """Start a dask client on a local cluster sized to the node
+    Args:
+        n_workers (int): number of worker processes, one per core if None
+        threads_per_worker (int): threads of each worker
+        memory_fraction (float): fraction of the node memory shared by the
+        workers, a worker spills to disk and pauses when it reaches its share
+    Returns:
+        client (dask.distributed Client)
+    """
+    if Client is None:
+        raise ImportError("dask.distributed is required for the distributed mode")
+    if n_workers is None:
+        n_workers = max(len(os.sched_getaffinity(0)) // threads_per_worker, 1)
+    node_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    cluster = LocalCluster(
+        n_workers=n_workers,
+        threads_per_worker=threads_per_worker,
+        memory_limit=int(node_memory * memory_fraction / n_workers),
+        processes=True,
+        dashboard_address=None,
+    )
+    return Client(cluster)
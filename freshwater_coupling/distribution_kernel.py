@@ -0,0 +1,150 @@
+"""This module contains the prepared kernel distributing Antarctic
+freshwater totals over the ocean grid.
+
+Classes: DistributionKernel
+"""
+
+import os
+import hashlib
+import xarray as xr
+
+
+class DistributionKernel:
+    """Class for the normalised distribution weights of calving and basal melt
+    ...
+
+    The weights are the distribution mask divided by the total area of the
+    masked ocean cells, so a flux per cell is one multiplication of the
+    weights with a total.
+
+    Attributes
+    ----------
+    weights (xarray dataset): socalving_f and sorunoff_f weights per cell [m^-2]
+    key (str): hash of the input files the weights were built from
+
+    Methods
+    -------
+    files_key
+        Hash names, sizes and modification times of the input files
+    build
+        Compute the normalised weights from the mask and area files
+    save
+        Write kernel to NetCDF file
+    load
+        Read kernel from NetCDF file
+    cached
+        Load kernel from cache or build and store it
+    forcing
+        Distribute calving and basal melt totals over the ocean grid
+    """
+
+    names = {"calving_mask": "socalving_f", "basal_melt_mask": "sorunoff_f"}
+
+    def __init__(self, weights, key=""):
+        self.weights = weights
+        self.key = key
+        for name in self.names.values():
+            assert name in weights, "missing weights " + name
+
+    @staticmethod
+    def files_key(*files):
+        """Hash names, sizes and modification times of the input files
+        Args:
+            files (str): paths to the input files
+        Returns:
+            key (str): hex digest
+        """
+        digest = hashlib.sha256()
+        for file in files:
+            stat = os.stat(file)
+            digest.update(
+                "{}:{}:{}".format(
+                    os.path.abspath(file), stat.st_size, stat.st_mtime_ns
+                ).encode()
+            )
+        return digest.hexdigest()
+
+    @classmethod
+    def build(cls, file_area, file_basal_melt_mask, file_calving_mask, key=""):
+        """Compute the normalised weights from the mask and area files
+        Args:
+            file_area (str): path to areacello file
+            file_basal_melt_mask (str): path to basal melt distribution mask
+            file_calving_mask (str): path to calving distribution mask
+            key (str): hash of the input files
+        Returns:
+            DistributionKernel
+        """
+        weights = {}
+        with xr.open_dataset(file_area) as ds_area:
+            areacello = ds_area.areacello.load()
+        for file in (file_calving_mask, file_basal_melt_mask):
+            with xr.open_dataset(file) as ds_mask:
+                ds_mask = ds_mask.load()
+            for mask_name, name in cls.names.items():
+                if mask_name in ds_mask:
+                    mask = ds_mask[mask_name]
+                    area = areacello.where(mask).sum("j").sum("i").values
+                    weights[name] = mask / float(area)
+        return cls(xr.Dataset(weights), key)
+
+    def save(self, file):
+        """Write kernel to NetCDF file
+        Args:
+            file (str): path to NetCDF file
+        """
+        tmp_file = file + "." + str(os.getpid()) + ".tmp"
+        weights = self.weights.copy()
+        weights.attrs["key"] = self.key
+        weights.to_netcdf(tmp_file)
+        os.replace(tmp_file, file)
+
+    @classmethod
+    def load(cls, file):
+        """Read kernel from NetCDF file
+        Args:
+            file (str): path to NetCDF file
+        Returns:
+            DistributionKernel
+        """
+        with xr.open_dataset(file) as weights:
+            weights = weights.load()
+        key = weights.attrs.pop("key", "")
+        return cls(weights, key)
+
+    @classmethod
+    def cached(cls, cache_dir, file_area, file_basal_melt_mask, file_calving_mask):
+        """Load kernel from cache or build and store it
+        Args:
+            cache_dir (str): directory of the kernel cache
+            file_area (str): path to areacello file
+            file_basal_melt_mask (str): path to basal melt distribution mask
+            file_calving_mask (str): path to calving distribution mask
+        Returns:
+            DistributionKernel
+        """
+        files = (file_area, file_basal_melt_mask, file_calving_mask)
+        key = cls.files_key(*files)
+        file = os.path.join(cache_dir, "distribution_kernel_" + key[:16] + ".nc")
+        if os.path.exists(file):
+            kernel = cls.load(file)
+            if kernel.key == key:
+                return kernel
+        kernel = cls.build(*files, key=key)
+        os.makedirs(cache_dir, exist_ok=True)
+        kernel.save(file)
+        return kernel
+
+    def forcing(self, calving_total, basal_total, scale=1.0):
+        """Distribute calving and basal melt totals over the ocean grid
+        Args:
+            calving_total (float): total calving
+            basal_total (float): total basal melt
+            scale (float): unit conversion applied to the totals
+        Returns:
+            fwf_calving (xarray dataset): socalving_f flux per cell
+            fwf_basal (xarray dataset): sorunoff_f flux per cell
+        """
+        fwf_calving = (self.weights.socalving_f * (calving_total * scale)).to_dataset()
+        fwf_basal = (self.weights.sorunoff_f * (basal_total * scale)).to_dataset()
+        return fwf_calving, fwf_basal
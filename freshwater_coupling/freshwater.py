@@ -4,12 +4,14 @@ calculations for different regions of Antarctica
 Classes: Freshwater
 """
 
+import os
 import numpy as np
 import pandas as pd
 import xarray as xr
-from scipy import ndimage
+from freshwater_coupling import instrumentation as IN
 from freshwater_coupling.amr_tools import Flatten as flt
 from freshwater_coupling.amr_tools import Masks as bisi_masks
+from freshwater_coupling.distribution_kernel import DistributionKernel
 
 
 class Freshwater:
@@ -19,14 +21,23 @@ class Freshwater:
     Attributes
     ----------
     regions (dict): Mapping from mask name to region
+    variables (list): BISICLES variables needed for the contributions
+    forcing_name (str): file name pattern of the yearly NEMO forcing files
+    forcing_encoding (dict): NetCDF encoding of the NEMO forcing fields
     flatten (str): path to flatten driver
     file1 (str): file1 name
     file2 (str): file2 name
+    weights_cache (dict): region weights kept in memory, keyed on mask path and shape
+    sums_cache (dict): regional sums of recently read plot files
+    distribution_cache (dict): ocean distribution kernels kept in memory
+    checkpoints (CheckpointCache): cache of regional sums, no checkpoints if None
 
     Methods
     -------
     get_sum
         Get the sum for each variable based on a file
+    open_plot
+        Open a BISICLES plot file
     Calving
         Discharge Calculation
     BasalMelt
@@ -35,22 +46,39 @@ class Freshwater:
         Calving Contribution
     AntarcticBasalContribution
         Basal Melt Contribuition
+    region_weights
+        Get region coverage fractions on the grid of the plot files
     maskRegion
-        Downsample masks, mask out region, take sum, output to dataframe
+        Weight by region coverage, take sum, output to dataframe
     Contributions
         Calving and Basal melt contribution for each region of Antarctica
+    regional_sums
+        Sum each variable over each region for several plot files at once
+    plot_sums
+        Regional sums of one plot file, reusing sums read ahead of time
     RegionalContribution
         Calving and Basal melt contribution for each region of Antarctica
+    distribution_kernel
+        Prepared ocean distribution weights, built once
+    write_nemo_forcing
+        Write compressed forcing file for NEMO
     """
 
     area = 64000000
     kg_per_Gt = 1e12  # [kg] to [Gt]
     spy = 3600 * 24 * 365  # [s yr^-1]
+    variables = ["thickness", "activeSurfaceThicknessSource", "activeBasalThicknessSource"]
+    forcing_name = "FWF_LRF_y{}.nc"
+    forcing_encoding = {"dtype": "float32", "zlib": True, "shuffle": True, "complevel": 4}
 
     def __init__(self, flatten, amr_file1, amr_file2):
         self.flatten = flatten
         self.amr_file1 = amr_file1
         self.amr_file2 = amr_file2
+        self.weights_cache = {}
+        self.sums_cache = {}
+        self.distribution_cache = {}
+        self.checkpoints = None
 
     def region(self, mask_path):
         """Get region masks and extract them
@@ -100,31 +128,46 @@ class Freshwater:
         bmb_gt = bmb_vol / (10**9) * (917.0 / 1000)
         return -bmb_gt
 
-    def mask_region(self, plot_dat, mask_dat):
-        """Downsample masks, mask out region, take sum, output to dataframe
+    def region_weights(self, mask_path, shape, cache_dir=None):
+        """Get region coverage fractions on the grid of the plot files
+        Args:
+            mask_path (str): path to amr mask files
+            shape (tuple): shape of the flattened plot file grid
+            cache_dir (str): directory of the mask and weight caches, defaults
+            to mask_path
+        Returns:
+            names (list of str) and weights (np.array): (region, y, x) fraction
+            of each cell inside each region
+        """
+        key = (mask_path, tuple(shape))
+        if key not in self.weights_cache:
+            with IN.stage("region_weights"):
+                self.weights_cache[key] = bisi_masks(
+                    mask_path, cache_dir
+                ).region_weights(shape)
+        names, weights = self.weights_cache[key]
+        return names, weights
+
+    def mask_region(self, plot_dat, mask_weights):
+        """Weight by region coverage, take sum, output to dataframe
         Args:
             plot_dat (xarray dataset): xarray dataset of BISICLES plot file
-            mask_dat (xarray dataset): xarray dataset of original mask file
+            mask_weights (np.array): fraction of each plot file cell inside region
         Returns:
             df (pandas dataframe): Dataframe of sum of each variable in
             BISICLES plot file for a certain region
         """
-        mask_int = mask_dat.astype(int)
-        new_mask = ndimage.interpolation.zoom(mask_int, 0.125)
         assert (
-            plot_dat.thickness.shape == new_mask.shape
+            plot_dat.thickness.shape == mask_weights.shape
         ), "arrays are not the same shape"
         cols = []
         sums = []
         for i in plot_dat:
             area = np.array(plot_dat[i])
-            mask_area = np.where(new_mask == 1, area, np.nan)
-            mask_sum = np.nansum(mask_area)
+            mask_sum = np.nansum(mask_weights * area)
             cols.append(i)
             sums.append(mask_sum)
-        sum_df = pd.DataFrame(columns=cols)
-        series = pd.Series(sums, index=sum_df.columns)
-        sum_df = sum_df.append(series, ignore_index=True)
+        sum_df = pd.DataFrame([sums], columns=cols)
         assert sum_df.empty is False, "Dataframe is empty"
         return sum_df
 
@@ -134,7 +177,7 @@ class Freshwater:
         Args:
             dat1 (xarray dataset): BISICLES plot file timestep 1
             dat2 (xarray dataset): BISICLES plot file timestep 2
-            mask_file (xarray dataset): mask file of region
+            mask_file (np.array): coverage fraction of region
         returns:
             calving_flux (float): Calving contribution in gigatonnes and bmb (float)
             basal melt contribution in gigatonnes
@@ -150,60 +193,172 @@ class Freshwater:
         bmb = self.basal_melt(df2.activeBasalThicknessSource)
         return calving_flux, bmb
 
-    def regional_contribution(self, mask_path, nc_out, driver):
+    def regional_sums(self, plot_dats, weights):
+        """Sum each variable over each region for several plot files at once
+        Args:
+            plot_dats (list of xarray datasets): BISICLES plot files
+            weights (np.array): (region, y, x) region coverage fractions
+        Returns:
+            sums (np.array): (file, variable, region) regional sums of
+            each variable in self.variables
+        """
+        fields = np.stack(
+            [
+                np.stack([np.asarray(dat[var]) for var in self.variables])
+                for dat in plot_dats
+            ]
+        )
+        assert fields.shape[2:] == weights.shape[1:], "arrays are not the same shape"
+        sums = np.tensordot(np.nan_to_num(fields), weights, axes=([2, 3], [1, 2]))
+        return sums
+
+    def plot_sums(
+        self, amr_file, mask_path, nc_out, driver, native=True, cache_dir=None
+    ):
+        """Regional sums of one plot file. The sums of the last two files are
+        kept, so a file summed ahead of time (e.g. while BISICLES runs) is not
+        read again. With checkpoints, sums of earlier runs are reused as well
+        Args:
+            amr_file (str): path to BISICLES plot file
+            mask_path (str): path to mask files
+            nc_out (str): path to netcdf output, only used by flatten
+            driver (str): BISICLES flatten driver path, only used by flatten
+            native (bool): read the AMR file directly instead of running flatten
+            cache_dir (str): directory of the region weight cache
+        Returns:
+            names (list of str) and sums (dict): regional sums of each variable
+        """
+        key = (amr_file, os.stat(amr_file).st_mtime_ns, mask_path)
+        if key not in self.sums_cache:
+
+            def compute():
+                dat = self.open_plot(amr_file, nc_out, driver, native)
+                names, weights = self.region_weights(
+                    mask_path, dat.thickness.shape, cache_dir
+                )
+                with IN.stage("regional_sums"):
+                    sums = self.regional_sums([dat], weights)[0]
+                dat.close()
+                return pd.DataFrame(sums, index=self.variables, columns=names)
+
+            if self.checkpoints is None:
+                sums_df = compute()
+            else:
+                with IN.stage("checkpoint_key"):
+                    checkpoint_key = self.checkpoints.key(
+                        [amr_file],
+                        masks=bisi_masks(mask_path).files_key(),
+                        variables=self.variables,
+                        native=native,
+                    )
+                sums_df = self.checkpoints.cached("regional_sums", checkpoint_key, compute)
+            names = list(sums_df.columns)
+            sums = {var: sums_df.loc[var].values for var in self.variables}
+            while len(self.sums_cache) >= 2:
+                self.sums_cache.pop(next(iter(self.sums_cache)))
+            self.sums_cache[key] = (names, sums)
+        return self.sums_cache[key]
+
+    def open_plot(self, amr_file, nc_out, driver, native=True):
+        """Open a BISICLES plot file
+        Args:
+            amr_file (str): path to BISICLES plot file
+            nc_out (str): path to netcdf output, only used by flatten
+            driver (str): BISICLES flatten driver path, only used by flatten
+            native (bool): read the AMR file directly instead of running flatten
+        Returns:
+            xarray dataset of the plot file
+        """
+        with IN.stage("read_plot"):
+            if native:
+                return flt(amr_file).read(self.variables)
+            return flt(amr_file).open(driver, nc_out)
+
+    def regional_contribution(
+        self, mask_path, nc_out, driver, native=True, cache_dir=None
+    ):
         """Calving and Basal melt contribution for each region of Antarctica
         Args:
             mask_path (str): path to mask files
             nc_out (str): path to netcdf output
-            driver (str): BISICLES nc2amr driver path
+            driver (str): BISICLES flatten driver path
+            native (bool): read the AMR files directly instead of running flatten
+            cache_dir (str): directory of the region weight cache
         Returns:
             discharge_df (pandas dataframe) and
             basal_df (pandas dataframe): dataframes of calving
             and basal melt contribution for all regions of Antarctica
         """
-        x, y, masks = self.region(mask_path)
-        dat1 = flt(self.amr_file1).open(driver, nc_out)
-        dat2 = flt(self.amr_file2).open(driver, nc_out)
-        discharge = {}
-        basal = {}
-        for key, mask in masks.items():
-            calving_flux, bmb = self.contributions(dat1, dat2, mask)
-            discharge[key] = calving_flux
-            basal[key] = bmb
-        discharge_df = pd.DataFrame.from_dict(discharge)
-        basal_df = pd.DataFrame.from_dict(basal)
+        names, sums1 = self.plot_sums(
+            self.amr_file1, mask_path, nc_out, driver, native, cache_dir
+        )
+        _, sums2 = self.plot_sums(
+            self.amr_file2, mask_path, nc_out, driver, native, cache_dir
+        )
+        calving_flux = self.calving(
+            sums2["activeSurfaceThicknessSource"] * self.area,
+            sums2["activeBasalThicknessSource"] * self.area,
+            sums1["thickness"] * self.area,
+            sums2["thickness"] * self.area,
+        )
+        bmb = self.basal_melt(sums2["activeBasalThicknessSource"])
+        discharge_df = pd.DataFrame([calving_flux], columns=names)
+        basal_df = pd.DataFrame([bmb], columns=names)
         return discharge_df, basal_df
 
-    def areaflux_calculation(self, fwf_df, distribution_area, distribution_mask):
-        """Calculate area forcing based on freshwater input"""
-        flux = fwf_df.values * self.kg_per_Gt / self.spy / float(distribution_area)
-        # Apply flux to masked region
-        fwforcing = flux * distribution_mask
-        #fwforcing = fwforcing.rename({"friver": "freshwater_flux"})
-        return fwforcing
+    def distribution_kernel(
+        self, file_area, file_basal_melt_mask, file_calving_mask, cache_dir=None
+    ):
+        """Prepared ocean distribution weights, built once per set of files and
+        stored in cache_dir if given
+        Args:
+            file_area (str): path to areacello file
+            file_basal_melt_mask (str): path to basal melt distribution mask
+            file_calving_mask (str): path to calving distribution mask
+            cache_dir (str): directory of the kernel cache
+        Returns:
+            DistributionKernel
+        """
+        key = (file_area, file_basal_melt_mask, file_calving_mask)
+        if key not in self.distribution_cache:
+            with IN.stage("distribution_kernel"):
+                if cache_dir is None:
+                    kernel = DistributionKernel.build(*key)
+                else:
+                    kernel = DistributionKernel.cached(cache_dir, *key)
+            self.distribution_cache[key] = kernel
+        return self.distribution_cache[key]
 
     def oceangrid_distribution(
-        self, discharge_df, basal_df, file_area, file_basal_melt_mask, file_calving_mask
+        self,
+        discharge_df,
+        basal_df,
+        file_area,
+        file_basal_melt_mask,
+        file_calving_mask,
+        cache_dir=None,
+        row=-1,
     ):
-        """Distribute freshwater input over ocean grid"""
-
-        basal_melt_mask = xr.open_dataset(file_basal_melt_mask)
-        calving_mask = xr.open_dataset(file_calving_mask)
-
-        ds_area = xr.open_dataset(file_area)
-        basal_melt_area = ds_area.areacello.where(basal_melt_mask.basal_melt_mask).sum('j').sum('i').values
-        calving_area = ds_area.areacello.where(calving_mask.calving_mask).sum('j').sum('i').values
-
-        fwf_calving = self.areaflux_calculation(
-            discharge_df, calving_area, calving_mask
+        """Distribute freshwater input over ocean grid
+        Args:
+            discharge_df, basal_df (pandas series): total calving and basal
+            melt in Gt per row
+            file_area (str): path to areacello file
+            file_basal_melt_mask (str): path to basal melt distribution mask
+            file_calving_mask (str): path to calving distribution mask
+            cache_dir (str): directory of the kernel cache
+            row (int): position of the row of the leg, the last row by default
+        Returns:
+            fwf_calving, fwf_basal (xarray dataset): flux per ocean cell
+        """
+        kernel = self.distribution_kernel(
+            file_area, file_basal_melt_mask, file_calving_mask, cache_dir
         )
-        fwf_basal = self.areaflux_calculation(
-            basal_df, basal_melt_area, basal_melt_mask
+        fwf_calving, fwf_basal = kernel.forcing(
+            float(discharge_df.iloc[row]),
+            float(basal_df.iloc[row]),
+            self.kg_per_Gt / self.spy,
         )
-
-        fwf_basal = fwf_basal.rename({'basal_melt_mask':'sorunoff_f'})
-        fwf_calving = fwf_calving.rename({'calving_mask':'socalving_f'})
-
         return fwf_calving, fwf_basal
 
     def create_time_dimension(self, file_thetao):
@@ -233,15 +388,47 @@ class Freshwater:
         ds_fwf = ds_fwf.assign_coords({"time_counter": time_attr.values})
         return ds_fwf
 
+    def write_nemo_forcing(self, ds_fwf, forcing_dir):
+        """Write forcing file for NEMO in single precision, compressed and
+        chunked per time record, renaming it into place once complete
+        Args:
+            ds_fwf (xarray dataset): freshwater forcing for NEMO
+            forcing_dir (str): directory of the forcing files of the experiment
+        Returns:
+            file (str): path to the FWF_LRF_y<year>.nc forcing file
+        """
+        year = int(ds_fwf.time_counter.dt.year[0])
+        file = os.path.join(forcing_dir, self.forcing_name.format(year))
+        encoding = {}
+        for name in ds_fwf.data_vars:
+            chunks = (1,) + ds_fwf[name].shape[1:]
+            encoding[name] = dict(self.forcing_encoding, chunksizes=chunks)
+        tmp_file = file + "." + str(os.getpid()) + ".tmp"
+        ds_fwf.to_netcdf(tmp_file, unlimited_dims=["time_counter"], encoding=encoding)
+        os.replace(tmp_file, file)
+        return file
+
     def calculate_nemo_forcing(
-        self, discharge_df, basal_df, file_area, file_basal_melt_mask, file_calving_mask, file_thetao
+        self,
+        discharge_df,
+        basal_df,
+        file_area,
+        file_basal_melt_mask,
+        file_calving_mask,
+        file_thetao,
+        cache_dir=None,
     ):
         """Calculate the freshwater distibution for NEMO based on dataframes of basal melt and calving"""
         sum_calving = discharge_df.sum(axis=1)
         sum_basal = basal_df.sum(axis=1)
         print(sum_calving, sum_basal)
         fwf_calving, fwf_basal = self.oceangrid_distribution(
-            sum_calving, sum_basal, file_area, file_basal_melt_mask, file_calving_mask
+            sum_calving,
+            sum_basal,
+            file_area,
+            file_basal_melt_mask,
+            file_calving_mask,
+            cache_dir,
         )
         ds_fwf = self.create_nemo_forcing(fwf_calving, fwf_basal, file_thetao)
         return ds_fwf
@@ -0,0 +1,216 @@
+"""This module contains the timing and memory instrumentation of the
+coupling stages. The stages of a leg are summed into one JSON line, appended
+to <exp>_timing.jsonl next to the coupling results.
+
+Classes: LegRecord
+Functions: stage, annotate, record
+"""
+
+import os
+import json
+import time
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# Record of the running leg, shared by all threads of the process
+ACTIVE = {"record": None}
+# Stack of open stages of each thread
+LOCAL = threading.local()
+
+
+def proc_io():
+    """Bytes read and written by this process so far, including reads served
+    from the page cache and network filesystems
+    Returns:
+        rchar, wchar (int), zero where /proc is not available
+    """
+    try:
+        with open("/proc/self/io") as io_stats:
+            stats = dict(line.split(":") for line in io_stats)
+        return int(stats["rchar"]), int(stats["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of this process, so the peak of a leg
+    is not hidden by earlier legs of a long-lived server"""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process since the last reset
+    Returns:
+        peak (float): peak resident memory in MB
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LegRecord:
+    """Class for the stage timings of one leg or coupling task
+    ...
+
+    Byte counts are for the whole process, so stages running at the same
+    time in different threads both count the bytes of either. External
+    tools run in child processes, only their duration is recorded.
+
+    Attributes
+    ----------
+    exp_name (str): experiment name
+    task (str): coupling task, e.g. leg or basalmelt
+    info (dict): further values written with the record, e.g. year
+    stages (dict): calls, wall time and bytes of each stage, keyed on the
+        stage name prefixed with the names of its enclosing stages
+    tools (dict): calls and wall time of each external tool
+
+    Methods
+    -------
+    add
+        Add one call of a stage
+    summary
+        Record as a dictionary
+    """
+
+    def __init__(self, exp_name, task):
+        self.exp_name = exp_name
+        self.task = task
+        self.info = {}
+        self.stages = {}
+        self.tools = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_io = proc_io()
+
+    def add(self, name, wall, read, written, tool=False):
+        """Add one call of a stage
+        Args:
+            name (str): stage name
+            wall (float): wall time in seconds
+            read, written (int): bytes read and written during the stage
+            tool (bool): the stage ran an external tool
+        """
+        with self.lock:
+            stages = self.tools if tool else self.stages
+            totals = stages.setdefault(
+                name, {"calls": 0, "wall_s": 0.0, "read_bytes": 0, "write_bytes": 0}
+            )
+            totals["calls"] += 1
+            totals["wall_s"] += wall
+            totals["read_bytes"] += read
+            totals["write_bytes"] += written
+
+    def summary(self):
+        """Record as a dictionary
+        Returns:
+            summary (dict): JSON serialisable record of the leg
+        """
+        read, written = proc_io()
+        summary = {
+            "exp_name": self.exp_name,
+            "task": self.task,
+            "start": datetime.fromtimestamp(self.start).isoformat(timespec="seconds"),
+            "wall_s": time.perf_counter() - self.start_wall,
+            "peak_rss_mb": peak_rss_mb(),
+            "read_bytes": read - self.start_io[0],
+            "write_bytes": written - self.start_io[1],
+        }
+        summary.update(self.info)
+        summary["stages"] = self.stages
+        summary["tools"] = self.tools
+        return summary
+
+
+@contextmanager
+def stage(name, tool=False):
+    """Time a stage of the running leg, does nothing outside of a leg
+    Args:
+        name (str): stage name
+        tool (bool): the stage runs an external tool
+    """
+    leg_record = ACTIVE["record"]
+    if leg_record is None:
+        yield
+        return
+    if not hasattr(LOCAL, "stack"):
+        LOCAL.stack = []
+    LOCAL.stack.append(name)
+    full_name = "/".join(LOCAL.stack)
+    start_io = proc_io()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        read, written = proc_io()
+        LOCAL.stack.pop()
+        leg_record.add(
+            full_name, wall, read - start_io[0], written - start_io[1], tool
+        )
+
+
+def annotate(**info):
+    """Add values to the record of the running leg, e.g. its year
+    Args:
+        info: values to write with the record
+    """
+    leg_record = ACTIVE["record"]
+    if leg_record is not None:
+        leg_record.info.update(info)
+
+
+@contextmanager
+def record(out_dir, exp_name, task, profile=False):
+    """Record the stages of a leg and append them as one JSON line to
+    <out_dir>/<exp_name>_timing.jsonl. Inside a running leg, the task is
+    recorded as a stage of that leg instead
+    Args:
+        out_dir (str): directory of the timing file
+        exp_name (str): experiment name
+        task (str): coupling task, e.g. leg or basalmelt
+        profile (bool): also write a cProfile dump of the task to
+        <out_dir>/<exp_name>_<task>_<time>.prof
+    """
+    if ACTIVE["record"] is not None:
+        with stage(task):
+            yield
+        return
+
+    reset_peak_rss()
+    leg_record = LegRecord(exp_name, task)
+    profiler = cProfile.Profile() if profile else None
+    ACTIVE["record"] = leg_record
+    status = "error"
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+        status = "ok"
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        ACTIVE["record"] = None
+        summary = leg_record.summary()
+        summary["status"] = status
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, exp_name + "_timing.jsonl"), "a") as timing:
+            timing.write(json.dumps(summary) + "\n")
+        if profiler is not None:
+            stamp = datetime.fromtimestamp(leg_record.start).strftime("%Y%m%dT%H%M%S")
+            profiler.dump_stats(
+                os.path.join(out_dir, "{}_{}_{}.prof".format(exp_name, task, stamp))
+            )
@@ -0,0 +1,227 @@
+"""This module contains the sparse interpolation of ocean column values to
+the BISICLES grid, used for the spatially resolved basal melt.
+
+Classes: OceanIceInterpolator
+Functions: polar_stereographic
+"""
+
+import os
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+# WGS84 ellipsoid and the true scale latitude of EPSG:3031, the projection of
+# the BISICLES grid
+EARTH_RADIUS = 6378137.0
+ECCENTRICITY = 0.0818191908426
+TRUE_SCALE_LAT = -71.0
+
+
+def polar_stereographic(lat, lon):
+    """Project latitude and longitude to Antarctic polar stereographic
+    co-ordinates (EPSG:3031), following Snyder (1987)
+    Args:
+        lat, lon (np.array): latitude and longitude in degrees
+    Returns:
+        x, y (np.array): co-ordinates in m
+    """
+    phi = np.deg2rad(-np.asarray(lat, dtype=float))
+    lam = np.deg2rad(-np.asarray(lon, dtype=float))
+    phi_c = np.deg2rad(-TRUE_SCALE_LAT)
+
+    def t_func(angle):
+        e_sin = ECCENTRICITY * np.sin(angle)
+        return np.tan(np.pi / 4 - angle / 2) / ((1 - e_sin) / (1 + e_sin)) ** (
+            ECCENTRICITY / 2
+        )
+
+    m_c = np.cos(phi_c) / np.sqrt(1 - (ECCENTRICITY * np.sin(phi_c)) ** 2)
+    rho = EARTH_RADIUS * m_c * t_func(phi) / t_func(phi_c)
+    return -rho * np.sin(lam), rho * np.cos(lam)
+
+
+class OceanIceInterpolator:
+    """Class for the sparse (ice cell x ocean value) interpolation matrix
+    ...
+
+    Each labelled cell of the BISICLES region raster gets the inverse distance
+    weighted mean of the nearest ocean columns of its own sector. Rows exist
+    only for labelled cells, so the matrix takes about 8 bytes per neighbour
+    and labelled cell, and it is applied in blocks of rows so evaluation
+    needs little memory beyond the output field.
+
+    Attributes
+    ----------
+    rows (np.array): flat index into the ice grid of each matrix row
+    matrix (scipy sparse matrix): (row, sector * ocean cell) weights
+    shape (tuple): (y, x) shape of the ice grid
+    key (str): hash of the inputs the matrix was built from
+
+    Methods
+    -------
+    build
+        Build the matrix from ocean column positions and the region raster
+    save
+        Write interpolator to npz file
+    load
+        Read interpolator from npz file
+    cached
+        Load interpolator from cache or build and store it
+    apply
+        Interpolate ocean column values to the ice grid
+    """
+
+    block_size = 2**20
+
+    def __init__(self, rows, matrix, shape, key=""):
+        self.rows = np.asarray(rows)
+        self.matrix = sparse.csr_matrix(matrix)
+        self.shape = tuple(shape)
+        self.key = key
+        assert self.matrix.shape[0] == self.rows.size, "one row per ice cell"
+
+    @classmethod
+    def build(cls, ocean_x, ocean_y, sector_cells, ice_x, ice_y, label, neighbours=4):
+        """Build the matrix from ocean column positions and the region raster
+        Args:
+            ocean_x, ocean_y (np.array): projected position of each ocean cell
+            sector_cells (list): for label k + 1 of the raster, the index of
+            its ocean sector and the ocean cells (np.array) inside that sector
+            to interpolate from
+            ice_x, ice_y (np.array): co-ordinates of the ice grid, in the
+            same frame as the ocean positions
+            label (np.array): (y, x) region raster, 0 outside all regions
+            neighbours (int): number of ocean columns averaged per ice cell
+        Returns:
+            OceanIceInterpolator
+        Raises:
+            ValueError if a region with ice cells has no ocean cells
+        """
+        n_cells = ocean_x.size
+        n_sectors = max(sector for sector, _ in sector_cells) + 1
+        rows, cols, weights = [], [], []
+        label = np.asarray(label)
+        assert label.shape == (ice_y.size, ice_x.size), "label is not (y, x)"
+        label = label.ravel()
+        for k, (sector, cells) in enumerate(sector_cells):
+            ice_cells = np.flatnonzero(label == k + 1)
+            if ice_cells.size == 0:
+                continue
+            if cells.size == 0:
+                raise ValueError(
+                    "no ocean columns for the {} cells of region {}".format(
+                        ice_cells.size, k + 1
+                    )
+                )
+            n_near = min(neighbours, cells.size)
+            tree = cKDTree(np.column_stack([ocean_x[cells], ocean_y[cells]]))
+            for start in range(0, ice_cells.size, cls.block_size):
+                block = ice_cells[start : start + cls.block_size]
+                points = np.column_stack(
+                    [ice_x[block % ice_x.size], ice_y[block // ice_x.size]]
+                )
+                dist, near = tree.query(points, n_near)
+                dist = dist.reshape(block.size, n_near)
+                near = near.reshape(block.size, n_near)
+                inverse = 1.0 / np.maximum(dist, 1.0)
+                rows.append(block)
+                cols.append((sector * n_cells + cells[near]).astype(np.int32))
+                weights.append(
+                    (inverse / inverse.sum(axis=1, keepdims=True)).astype(np.float32)
+                )
+
+        n_near = max([w.shape[1] for w in weights], default=0)
+        rows_arr = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        data = np.zeros((rows_arr.size, n_near), dtype=np.float32)
+        indices = np.zeros((rows_arr.size, n_near), dtype=np.int32)
+        start = 0
+        for col, weight in zip(cols, weights):
+            stop = start + col.shape[0]
+            # Sectors with fewer ocean cells than neighbours get zero weights
+            data[start:stop, : weight.shape[1]] = weight
+            indices[start:stop, : col.shape[1]] = col
+            start = stop
+        matrix = sparse.csr_matrix(
+            (data.ravel(), indices.ravel(), np.arange(rows_arr.size + 1) * n_near),
+            shape=(rows_arr.size, n_sectors * n_cells),
+        )
+        return cls(rows_arr, matrix, (ice_y.size, ice_x.size))
+
+    def save(self, file):
+        """Write interpolator to npz file
+        Args:
+            file (str): path to npz file
+        """
+        tmp_file = file + "." + str(os.getpid()) + ".tmp.npz"
+        np.savez(
+            tmp_file,
+            rows=self.rows,
+            data=self.matrix.data,
+            indices=self.matrix.indices,
+            indptr=self.matrix.indptr,
+            matrix_shape=np.array(self.matrix.shape),
+            shape=np.array(self.shape),
+            key=np.array(self.key),
+        )
+        os.replace(tmp_file, file)
+
+    @classmethod
+    def load(cls, file):
+        """Read interpolator from npz file
+        Args:
+            file (str): path to npz file
+        Returns:
+            OceanIceInterpolator
+        """
+        with np.load(file) as npz:
+            matrix = sparse.csr_matrix(
+                (npz["data"], npz["indices"], npz["indptr"]),
+                shape=tuple(int(n) for n in npz["matrix_shape"]),
+            )
+            return cls(npz["rows"], matrix, tuple(npz["shape"]), str(npz["key"]))
+
+    @classmethod
+    def cached(cls, cache_dir, key, build):
+        """Load interpolator from cache or build and store it
+        Args:
+            cache_dir (str): directory of the interpolator cache
+            key (str): hash of the inputs
+            build (callable): function returning a new OceanIceInterpolator
+        Returns:
+            OceanIceInterpolator
+        """
+        file = os.path.join(cache_dir, "ocean_ice_" + key[:16] + ".npz")
+        if os.path.exists(file):
+            interpolator = cls.load(file)
+            if interpolator.key == key:
+                return interpolator
+        interpolator = build()
+        interpolator.key = key
+        os.makedirs(cache_dir, exist_ok=True)
+        interpolator.save(file)
+        return interpolator
+
+    def apply(self, values):
+        """Interpolate ocean column values to the ice grid. Nan ocean values
+        are left out of the weighted mean, cells without any valid neighbour
+        and cells outside all regions are 0
+        Args:
+            values (np.array): (sector, ocean cell) values
+        Returns:
+            field (np.array): (y, x) field on the ice grid
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        assert values.size == self.matrix.shape[1], "values do not match matrix"
+        valid = np.isfinite(values)
+        filled = np.where(valid, values, 0)
+        field = np.zeros(self.shape)
+        flat_field = field.reshape(-1)
+        for start in range(0, self.rows.size, self.block_size):
+            block = self.matrix[start : start + self.block_size]
+            total = block @ filled
+            norm = block @ valid.astype(float)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                flat_field[self.rows[start : start + self.block_size]] = np.where(
+                    norm > 0, total / norm, 0
+                )
+        return field
@@ -0,0 +1,130 @@
+"""This module is for reprocessing many ocean temperature files in
+parallel, e.g. for spin-up analysis or offline reruns of whole experiments.
+
+Classes: ParallelBasalMelt
+"""
+
+import os
+from glob import glob
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from freshwater_coupling.basal_melt import BasalMelt
+
+# Per-process BasalMelt instance, set by the pool initializer
+WORKER = {}
+
+
+def prepared_basal_melt(area, gamma, cache_dir, chunks, reference):
+    """BasalMelt instance with the grid weights of the ocean grid built, or
+    loaded from the cache
+    Args:
+        area (str): path to areacello file
+        gamma (float): gamma value
+        cache_dir (str): directory of the sector operator cache
+        chunks (dict): dask chunks used to open thetao files
+        reference (str): thetao file defining the ocean grid
+    Returns:
+        BasalMelt
+    """
+    basal_melt = BasalMelt(reference, area, gamma, cache_dir, chunks)
+    basal_melt.prepare_operator(reference)
+    return basal_melt
+
+
+def init_worker(area, gamma, cache_dir, chunks, reference):
+    """Pool initializer, build the grid weights once per worker process,
+    see prepared_basal_melt for the arguments"""
+    WORKER["basal_melt"] = prepared_basal_melt(area, gamma, cache_dir, chunks, reference)
+
+
+def process_file(file):
+    """Calculate sector temperature for every year of a file. Basal melt is
+    computed and validated after all files are gathered, so a bad year does
+    not stop the other files
+    Args:
+        file (str): thetao file
+    Returns:
+        thetao_df (pandas dataframe)
+    """
+    return WORKER["basal_melt"].yearly_mean_df([file])
+
+
+class ParallelBasalMelt:
+    """Class for spreading thetao files over a process pool
+    ...
+
+    Attributes
+    ----------
+    area (str): path to areacello file
+    gamma (float): gamma value
+    cache_dir (str): directory of the sector operator cache
+    processes (int): number of worker processes, all cores if None
+    chunks (dict): dask chunks used to open thetao files
+
+    Methods
+    -------
+    run
+        Calculate sector temperature and basal melt for all files
+    to_file
+        Write a year indexed table to csv or parquet
+    """
+
+    def __init__(self, area, gamma, cache_dir=None, processes=None, chunks=None):
+        self.area = area
+        self.gamma = gamma
+        self.cache_dir = cache_dir
+        self.processes = processes
+        self.chunks = chunks
+
+    def run(self, files):
+        """Calculate sector temperature and basal melt for all files. Invalid
+        basal melt anomalies do not stop the run, they are listed in the report
+        Args:
+            files (list of str or str): thetao files or glob pattern
+        Returns:
+            thetao_df (pandas dataframe) and basalmelt_df (pandas dataframe):
+            (year x sector) tables ordered by year and report (pandas
+            dataframe): invalid anomalies, see BasalMelt.melt_anomalies
+        """
+        if isinstance(files, str):
+            files = sorted(glob(files))
+        assert len(files) != 0, "no thetao files found"
+
+        # Build the operator in the parent first, workers then load it
+        # from the cache instead of all building it at the same time
+        if self.cache_dir is not None:
+            basal_melt = prepared_basal_melt(
+                self.area, self.gamma, self.cache_dir, self.chunks, files[0]
+            )
+        else:
+            basal_melt = BasalMelt(
+                files[0], self.area, self.gamma, self.cache_dir, self.chunks
+            )
+
+        initargs = (self.area, self.gamma, self.cache_dir, self.chunks, files[0])
+        with Pool(self.processes, initializer=init_worker, initargs=initargs) as pool:
+            results = pool.map(process_file, files, chunksize=1)
+
+        thetao_df = pd.concat(results).sort_index()
+        base = np.array([basal_melt.baseline.get(column) for column in thetao_df])
+        delta_basalmelt, _, report = basal_melt.melt_anomalies(
+            thetao_df.values,
+            base,
+            dims={"year": thetao_df.index, "sector": thetao_df.columns},
+        )
+        basalmelt_df = pd.DataFrame(
+            -delta_basalmelt, index=thetao_df.index, columns=thetao_df.columns
+        )
+        return thetao_df, basalmelt_df, report
+
+    def to_file(self, table_df, file):
+        """Write a year indexed table to csv or parquet, based on file extension
+        Args:
+            table_df (pandas dataframe): table to write
+            file (str): path to output file
+        """
+        if os.path.splitext(file)[1] == ".parquet":
+            table_df.to_parquet(file)
+        else:
+            table_df.to_csv(file)
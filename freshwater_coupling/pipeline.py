@@ -0,0 +1,164 @@
+"""This module contains the pipelined scheduler of one coupling leg,
+which overlaps the freshwater preparation with the BISICLES run.
+
+Classes: LegPipeline
+"""
+
+import os
+import subprocess
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from freshwater_coupling import instrumentation as IN
+from freshwater_coupling.bisicles_wait import BisiclesWaiter
+
+
+class LegPipeline:
+    """Class for running basal melt, BISICLES and freshwater for one leg
+    ...
+
+    Basal melt has to finish before BISICLES is submitted. While BISICLES
+    runs, the previous plot file is summed over the regions and the ocean
+    distribution areas are integrated, so after the new plot file arrives
+    only its own regional sums and the forcing file remain.
+
+    Attributes
+    ----------
+    service (CouplingService): coupling steps with warm state
+    exp_name (str): experiment name
+    gamma (float): gamma value
+    bm_name (str): name of basal melt file
+    start_dir (str): directory containing BasalMeltCoupling
+    outpath (str): BISICLES output path
+    nemo_path (str): NEMO output directory of the leg
+    nc2amr (str): path to BISICLES nc2amr driver
+    flatten (str): path to BISICLES flatten driver
+    driver (str): path to BISICLES driver
+    bisi_input (str): path to BISICLES input data
+
+    Methods
+    -------
+    submit_bisicles
+        Fill in the submission template and submit BISICLES
+    run
+        Run the leg
+    """
+
+    template = "BISICLES_submission_template.slurm"
+    submission = "BISICLES_submission.slurm"
+
+    def __init__(
+        self,
+        service,
+        exp_name,
+        gamma,
+        bm_name,
+        start_dir,
+        outpath,
+        nemo_path,
+        nc2amr,
+        flatten,
+        driver,
+        bisi_input,
+    ):
+        self.service = service
+        self.exp_name = exp_name
+        self.gamma = gamma
+        self.bm_name = bm_name
+        self.start_dir = start_dir
+        self.outpath = outpath
+        self.nemo_path = nemo_path
+        self.nc2amr = nc2amr
+        self.flatten = flatten
+        self.driver = driver
+        self.bisi_input = bisi_input
+
+    def submit_bisicles(self):
+        """Fill in the submission template and submit BISICLES
+        Returns:
+            jid (str): slurm job id
+        """
+        path = os.path.join(self.start_dir, "BasalMeltCoupling")
+        with open(os.path.join(path, self.template)) as template:
+            script = template.read()
+        substitutions = {
+            "@melt": self.bm_name + ".2d.hdf5",
+            "@exp": self.exp_name,
+            "@out": self.outpath,
+            "@driver": self.driver,
+            "@bisi": self.bisi_input,
+            "@sdir": self.start_dir,
+        }
+        for key, value in substitutions.items():
+            script = script.replace(key, value)
+        submission = os.path.join(path, self.submission)
+        with open(submission, "w") as slurm:
+            slurm.write(script)
+        with IN.stage("sbatch", tool=True):
+            output = subprocess.run(
+                ["sbatch", submission], check=True, stdout=subprocess.PIPE
+            ).stdout.decode()
+        jid = output.split()[3]
+        print(jid)
+        return jid
+
+    def run(self):
+        """Run the leg
+        Raises:
+            RuntimeError if BISICLES failed or wrote no plot file
+        """
+        path = os.path.join(self.start_dir, "BasalMeltCoupling")
+        self.service.basalmelt(
+            self.exp_name,
+            self.gamma,
+            self.bm_name,
+            self.start_dir,
+            self.outpath,
+            self.nemo_path,
+            self.nc2amr,
+        )
+        # Without a restart checkpoint BISICLES also writes the plot of t=0
+        restart = glob(self.outpath + "/checkpoints/chk.*")
+        # The waiter notes the error stream of the previous job before submitting
+        waiter = BisiclesWaiter(
+            None,
+            self.outpath + "/plots/hdf5",
+            self.exp_name,
+            os.path.join(path, "err.0"),
+            new_plots=1 if restart else 2,
+        )
+        jid = self.submit_bisicles()
+        waiter.sentinel = os.path.join(path, jid + ".txt")
+
+        print("waiting for BISICLES...")
+        try:
+            with ThreadPoolExecutor(1) as pool:
+                prefetch = pool.submit(
+                    self.service.prefetch_freshwater,
+                    self.exp_name,
+                    self.start_dir,
+                    self.flatten,
+                    self.outpath,
+                )
+                with IN.stage("bisicles", tool=True):
+                    plot = waiter.wait_plot()
+                try:
+                    prefetch.result()
+                except Exception as error:  # only an optimisation
+                    print("freshwater prefetch failed, recomputing:", repr(error))
+            if plot is None:
+                raise RuntimeError("Something went wrong, no plot")
+            print("...BISICLES done!")
+
+            self.service.freshwater(
+                self.exp_name,
+                self.start_dir,
+                self.flatten,
+                self.outpath,
+                self.nemo_path,
+                plot,
+            )
+        finally:
+            # BISICLES may still write its checkpoint after the plot file,
+            # the next leg restarts from it
+            with IN.stage("bisicles_finish", tool=True):
+                waiter.wait_done()
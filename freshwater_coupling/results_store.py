@@ -0,0 +1,143 @@
+"""This module contains the year keyed store of coupling results, one
+NetCDF file per experiment.
+
+Classes: ResultsStore
+"""
+
+import os
+from glob import iglob
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+class ResultsStore:
+    """Class for year keyed coupling results of several experiments
+    ...
+
+    Each experiment is one NetCDF file with an unlimited year dimension and
+    one (year, <table>_column) variable per table, e.g. bm, discharge and
+    basal. Writing a year that is already stored replaces it, so a rerun
+    leg does not add rows.
+
+    Attributes
+    ----------
+    path (str): directory of the results files
+
+    Methods
+    -------
+    file
+        Path of the results file of an experiment
+    experiments
+        Names of the stored experiments
+    read
+        Read all tables of an experiment
+    upsert
+        Insert or replace the rows of a table
+    table
+        Read one table of an experiment as dataframe
+    query
+        Read one table of several experiments as dataframe
+    """
+
+    suffix = "_results.nc"
+
+    def __init__(self, path):
+        self.path = path
+
+    def file(self, exp_name):
+        """Path of the results file of an experiment
+        Args:
+            exp_name (str): experiment name
+        Returns:
+            file (str)
+        """
+        return os.path.join(self.path, exp_name + self.suffix)
+
+    def experiments(self):
+        """Names of the stored experiments
+        Returns:
+            experiments (list): experiment names (str)
+        """
+        files = iglob(os.path.join(self.path, "*" + self.suffix))
+        return sorted(os.path.basename(file)[: -len(self.suffix)] for file in files)
+
+    def read(self, exp_name):
+        """Read all tables of an experiment
+        Args:
+            exp_name (str): experiment name
+        Returns:
+            results (xarray dataset), empty if nothing is stored
+        """
+        if not os.path.exists(self.file(exp_name)):
+            return xr.Dataset()
+        with xr.open_dataset(self.file(exp_name)) as results:
+            return results.load()
+
+    def upsert(self, exp_name, table, table_df, year=None):
+        """Insert or replace the rows of a table
+        Args:
+            exp_name (str): experiment name
+            table (str): table name, e.g. bm
+            table_df (pandas dataframe): rows to store, indexed by year
+            year (int): year of all rows, overrides the index of table_df
+        """
+        years = table_df.index.values if year is None else [year] * len(table_df)
+        column = table + "_column"
+        new = xr.DataArray(
+            np.asarray(table_df.values, dtype=float),
+            dims=("year", column),
+            coords={"year": np.asarray(years, dtype=int), column: list(table_df.columns)},
+            name=table,
+        )
+        # Last row wins for a year written twice in one call
+        new = new.isel(year=~pd.Index(years).duplicated(keep="last"))
+
+        results = self.read(exp_name)
+        if table in results:
+            new = new.combine_first(results[table])
+            results = results.drop_vars([table, column])
+        results = xr.merge([results, new]).sortby("year")
+
+        os.makedirs(self.path, exist_ok=True)
+        tmp_file = self.file(exp_name) + "." + str(os.getpid()) + ".tmp"
+        results.to_netcdf(tmp_file, unlimited_dims=["year"])
+        os.replace(tmp_file, self.file(exp_name))
+
+    def table(self, exp_name, table):
+        """Read one table of an experiment as dataframe
+        Args:
+            exp_name (str): experiment name
+            table (str): table name
+        Returns:
+            table_df (pandas dataframe): indexed by year, years without
+            values for this table are dropped
+        """
+        results = self.read(exp_name)
+        if table not in results:
+            return pd.DataFrame()
+        table_df = results[table].to_pandas().dropna(how="all")
+        table_df.columns.name = None
+        return table_df
+
+    def query(self, table, experiments=None, years=None):
+        """Read one table of several experiments as dataframe
+        Args:
+            table (str): table name
+            experiments (list): experiment names, all stored ones if None
+            years (list): years to select, all if None
+        Returns:
+            table_df (pandas dataframe): indexed by experiment and year
+        """
+        if experiments is None:
+            experiments = self.experiments()
+        tables = {}
+        for exp_name in experiments:
+            table_df = self.table(exp_name, table)
+            if years is not None:
+                table_df = table_df[table_df.index.isin(years)]
+            if not table_df.empty:
+                tables[exp_name] = table_df
+        if not tables:
+            return pd.DataFrame()
+        return pd.concat(tables, names=["experiment", "year"])
@@ -0,0 +1,270 @@
+"""This module contains the combined sector weight operator used to
+reduce ocean temperature to one value per Antarctic sector.
+
+Classes: SectorOperator
+"""
+
+import os
+import hashlib
+import numpy as np
+from scipy import sparse
+
+
+class SectorOperator:
+    """Class for the combined (sector x lev x j x i) weight operator
+    ...
+
+    The operator is stored factorised as a sparse (sector, j*i) matrix of
+    area weights and a dense (sector, lev) matrix of layer thickness weights.
+
+    Attributes
+    ----------
+    sectors (list): list of sector names (str)
+    area_weights (scipy sparse matrix): (sector, j*i) area weights of each sector
+    lev_weights (np.array): (sector, lev) layer thickness weights of each sector
+    grid_shape (tuple): (j, i) shape of the ocean grid
+    key (str): hash of the inputs the operator was built from
+
+    Methods
+    -------
+    grid_key
+        Hash the grid, sector bounds and shelf depths
+    from_arrays
+        Create operator from dense sector and layer weights
+    save
+        Write operator to npz file
+    load
+        Read operator from npz file
+    cached
+        Load operator from cache or build and store it
+    hyperslab
+        Find the layer and row ranges with non-zero weights
+    restrict
+        Restrict operator to a hyperslab of the grid
+    area_means
+        Compute area weighted mean of each sector per layer
+    depth_means
+        Compute depth weighted mean of the layer means
+    apply
+        Compute volume weighted mean of each sector
+    column_means
+        Compute depth weighted mean of each grid column
+    sector_cells
+        Grid cells with non-zero area weight in a sector
+    """
+
+    def __init__(self, sectors, area_weights, lev_weights, grid_shape, key=""):
+        self.sectors = list(sectors)
+        self.area_weights = sparse.csr_matrix(area_weights)
+        self.lev_weights = np.asarray(lev_weights, dtype=float)
+        self.grid_shape = tuple(grid_shape)
+        self.key = key
+        assert self.area_weights.shape[0] == len(self.sectors), "one row per sector"
+        assert self.lev_weights.shape[0] == len(self.sectors), "one row per sector"
+
+    @staticmethod
+    def grid_key(area_ds, lev_bnds, sector_bounds, shelf_depth, sectors):
+        """Hash the grid, sector bounds, shelf depths and sector order
+        Args:
+            area_ds (xarray dataset): areacello dataset
+            lev_bnds (xarray dataarray): ocean depth bands array
+            sector_bounds (dict): coordinates of each sector
+            shelf_depth (dict): shelf base depth of each sector
+            sectors (list): sector names, in the order of the operator rows
+        Returns:
+            key (str): hex digest identifying the operator
+        """
+        digest = hashlib.sha256()
+        for arr in (
+            area_ds.coords["latitude"],
+            area_ds.coords["longitude"],
+            area_ds.areacello.fillna(0),
+            lev_bnds,
+        ):
+            digest.update(np.ascontiguousarray(arr.values, dtype=float).tobytes())
+        digest.update(repr(sorted(sector_bounds.items())).encode())
+        digest.update(repr(sorted(shelf_depth.items())).encode())
+        digest.update(repr(list(sectors)).encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def from_arrays(cls, sectors, sector_weights, lev_weights, key=""):
+        """Create operator from dense sector and layer weights
+        Args:
+            sectors (list): list of sector names (str)
+            sector_weights (np.array): (sector, j, i) area weights
+            lev_weights (np.array): (sector, lev) layer thickness weights
+            key (str): hash of the inputs
+        Returns:
+            SectorOperator
+        """
+        sector_weights = np.asarray(sector_weights, dtype=float)
+        grid_shape = sector_weights.shape[1:]
+        area_weights = sector_weights.reshape(len(sectors), -1)
+        return cls(sectors, area_weights, lev_weights, grid_shape, key)
+
+    def save(self, file):
+        """Write operator to npz file
+        Args:
+            file (str): path to npz file
+        """
+        tmp_file = file + "." + str(os.getpid()) + ".tmp.npz"
+        np.savez_compressed(
+            tmp_file,
+            sectors=np.array(self.sectors),
+            data=self.area_weights.data,
+            indices=self.area_weights.indices,
+            indptr=self.area_weights.indptr,
+            lev_weights=self.lev_weights,
+            grid_shape=np.array(self.grid_shape),
+            key=np.array(self.key),
+        )
+        os.replace(tmp_file, file)
+
+    @classmethod
+    def load(cls, file):
+        """Read operator from npz file
+        Args:
+            file (str): path to npz file
+        Returns:
+            SectorOperator
+        """
+        with np.load(file) as npz:
+            sectors = [str(sector) for sector in npz["sectors"]]
+            grid_shape = tuple(int(n) for n in npz["grid_shape"])
+            area_weights = sparse.csr_matrix(
+                (npz["data"], npz["indices"], npz["indptr"]),
+                shape=(len(sectors), int(np.prod(grid_shape))),
+            )
+            return cls(
+                sectors, area_weights, npz["lev_weights"], grid_shape, str(npz["key"])
+            )
+
+    @classmethod
+    def cached(cls, cache_dir, key, build):
+        """Load operator from cache or build and store it
+        Args:
+            cache_dir (str): directory of the operator cache
+            key (str): hash of the inputs, see grid_key
+            build (callable): function returning a new SectorOperator
+        Returns:
+            SectorOperator
+        """
+        file = os.path.join(cache_dir, "sector_operator_" + key[:16] + ".npz")
+        if os.path.exists(file):
+            operator = cls.load(file)
+            if operator.key == key:
+                return operator
+        operator = build()
+        operator.key = key
+        os.makedirs(cache_dir, exist_ok=True)
+        operator.save(file)
+        return operator
+
+    def hyperslab(self):
+        """Find the layer and row ranges with non-zero weights
+        Returns:
+            lev_slice, j_slice (slice): smallest ranges of ocean layers and
+            grid rows that contain all non-zero weights
+        """
+        levs = np.flatnonzero(np.any(self.lev_weights > 0, axis=0))
+        cols = np.unique(self.area_weights.indices[self.area_weights.data != 0])
+        rows = cols // self.grid_shape[1]
+        assert levs.size != 0 and rows.size != 0, "operator has no weights"
+        lev_slice = slice(int(levs[0]), int(levs[-1]) + 1)
+        j_slice = slice(int(rows.min()), int(rows.max()) + 1)
+        return lev_slice, j_slice
+
+    def restrict(self, lev_slice, j_slice):
+        """Restrict operator to a hyperslab of the grid
+        Args:
+            lev_slice (slice): range of ocean layers
+            j_slice (slice): range of grid rows
+        Returns:
+            SectorOperator acting on thetao[lev_slice, j_slice, :]
+        """
+        n_i = self.grid_shape[1]
+        j_start, j_stop, _ = j_slice.indices(self.grid_shape[0])
+        area_weights = self.area_weights[:, j_start * n_i : j_stop * n_i]
+        lev_weights = self.lev_weights[:, lev_slice]
+        grid_shape = (j_stop - j_start, n_i)
+        return SectorOperator(
+            self.sectors, area_weights, lev_weights, grid_shape, self.key
+        )
+
+    def area_means(self, thetao):
+        """Compute area weighted mean ocean temperature of each sector, per
+        layer and ignoring land points
+        Args:
+            thetao (np.array): (..., j, i) ocean temperature, e.g. one layer
+            or a stack of layers
+        Returns:
+            awm (np.array): (..., sector) area weighted mean ocean temperature
+        """
+        thetao = np.asarray(thetao)
+        assert thetao.shape[-2:] == self.grid_shape, "thetao does not match grid"
+        lead_shape = thetao.shape[:-2]
+        thetao = thetao.reshape(-1, self.area_weights.shape[1])
+        valid = np.isfinite(thetao)
+        awm_sum = self.area_weights @ np.where(valid, thetao, 0).T
+        awm_norm = self.area_weights @ valid.T.astype(float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            awm = np.where(awm_norm > 0, awm_sum / awm_norm, np.nan)
+        return np.moveaxis(awm.reshape((len(self.sectors),) + lead_shape), 0, -1)
+
+    def depth_means(self, awm):
+        """Compute depth weighted mean of the area weighted means of each
+        layer, ignoring empty layers
+        Args:
+            awm (np.array): (..., sector, lev) area weighted mean ocean temperature
+        Returns:
+            vwm (np.array): (..., sector) volume weighted mean ocean temperature
+        """
+        awm_valid = np.isfinite(awm)
+        vwm_sum = np.sum(np.where(awm_valid, awm, 0) * self.lev_weights, axis=-1)
+        vwm_norm = np.sum(awm_valid * self.lev_weights, axis=-1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            vwm = np.where(vwm_norm > 0, vwm_sum / vwm_norm, np.nan)
+        return vwm
+
+    def apply(self, thetao):
+        """Compute volume weighted mean ocean temperature of each sector
+        Args:
+            thetao (np.array): (..., lev, j, i) ocean temperature, e.g. one
+            annual mean or a stack of annual means
+        Returns:
+            vwm (np.array): (..., sector) volume weighted mean ocean temperature
+        """
+        awm = self.area_means(thetao)
+        return self.depth_means(np.moveaxis(awm, -1, -2))
+
+    def column_means(self, thetao):
+        """Compute depth weighted mean ocean temperature of each grid column,
+        over the depth range of each sector and ignoring land points
+        Args:
+            thetao (np.array): (lev, j, i) annual mean ocean temperature
+        Returns:
+            cwm (np.array): (sector, j*i) depth weighted mean of each column,
+            nan outside of a sector and where a column has no valid layer in
+            the depth range of a sector
+        """
+        thetao = np.asarray(thetao)
+        assert thetao.shape[-2:] == self.grid_shape, "thetao does not match grid"
+        thetao = thetao.reshape(self.lev_weights.shape[1], -1)
+        valid = np.isfinite(thetao)
+        cwm_sum = self.lev_weights @ np.where(valid, thetao, 0)
+        cwm_norm = self.lev_weights @ valid.astype(float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cwm = np.where(cwm_norm > 0, cwm_sum / cwm_norm, np.nan)
+        cwm[self.area_weights.toarray() == 0] = np.nan
+        return cwm
+
+    def sector_cells(self, sector):
+        """Grid cells with non-zero area weight in a sector
+        Args:
+            sector (str): sector name
+        Returns:
+            cells (np.array): flat (j*i) index of each cell of the sector
+        """
+        row = self.area_weights[self.sectors.index(sector)]
+        return np.sort(row.indices[row.data != 0])
@@ -0,0 +1,391 @@
+"""This module contains the per-leg coupling steps and a long-lived
+coupling server, which keeps grid weights and masks in memory for the whole
+EC-Earth run and accepts requests over a Unix socket.
+
+Classes: CouplingService, CouplingHandler, CouplingServer
+"""
+
+import os
+import sys
+import json
+import traceback
+import socketserver
+from glob import iglob
+import xarray as xr
+from freshwater_coupling import basal_melt as BM
+from freshwater_coupling import freshwater as FW
+from freshwater_coupling import instrumentation as IN
+from freshwater_coupling.cluster import local_client
+from freshwater_coupling.pipeline import LegPipeline
+from freshwater_coupling.checkpoints import CheckpointCache
+from freshwater_coupling.results_store import ResultsStore
+
+# Input files relative to the BasalMeltCoupling directory
+MASK_DIR = "/inputs/levermann_masks/"
+AREA_FILE = "/inputs/ec-earth_data/areacello_Ofx_EC-Earth3_historical_r1i1p1f1_gn.nc"
+BM_MASK_FILE = "/inputs/ec-earth_data/basal_melt_mask_ORCA1_ocean.nc"
+CALVING_MASK_FILE = "/inputs/ec-earth_data/calving_mask_ORCA1_ocean.nc"
+FORCING_DIR = "/inputs/forcing/"
+# Below the BISICLES output path, apart from the BISICLES restart checkpoints
+CHECKPOINT_DIR = "/cache/checkpoints/"
+
+# Write a cProfile dump of each task next to its timing record
+PROFILE = os.environ.get("COUPLING_PROFILE", "0") not in ("", "0")
+# Workers of a local dask cluster for the sector means, computed in the
+# server process if 0 (see freshwater_coupling/cluster.py)
+DASK_WORKERS = int(os.environ.get("COUPLING_DASK_WORKERS", "0"))
+# Spatially resolved basal melt, interpolated from this number of nearest
+# ocean columns per BISICLES cell, one value per sector if 0
+MELT_FIELD = int(os.environ.get("COUPLING_MELT_FIELD", "0"))
+# Ocean sectors, the name of a set in freshwater_coupling/sector_sets or a
+# json file with the same layout
+SECTOR_SET = os.environ.get("COUPLING_SECTOR_SET", "levermann")
+
+
+def new_path(path_name):
+    """Create directory if it does not exist
+    Args:
+        path_name (str): path to directory
+    Returns:
+        path_name (str)
+    """
+    if not os.path.exists(path_name):
+        os.makedirs(path_name)
+    return path_name
+
+
+def leg_year(thetao_file):
+    """Year of a leg, from the NEMO output of the leg
+    Args:
+        thetao_file (str): path to NEMO thetao file of the leg
+    Returns:
+        year (int)
+    """
+    with xr.open_dataset(thetao_file) as thetao_ds:
+        return int(thetao_ds.time_counter.dt.year[0])
+
+
+class CouplingService:
+    """Class for the coupling steps of one leg, keeping the objects that only
+    depend on static inputs alive between legs
+    ...
+
+    Attributes
+    ----------
+    basal_melts (dict): BasalMelt instances with their sector operator,
+        keyed on area file, gamma, cache directory and sector set
+    freshwaters (dict): Freshwater instances with their region weights,
+        keyed on flatten driver
+    client (dask.distributed Client): local cluster for the sector means,
+        started on first use if DASK_WORKERS is set
+
+    Methods
+    -------
+    basalmelt
+        Calculate basal melt for a leg and map it to a BISICLES AMR file
+    freshwater
+        Calculate freshwater input for a leg and the NEMO forcing file
+    basalmelt_steps, freshwater_steps
+        Steps of the basal melt and freshwater calculations
+    prefetch_freshwater
+        Do the freshwater work that does not depend on the new plot file
+    leg
+        Run a whole leg through the pipelined scheduler
+    evict_checkpoints
+        Remove checkpoints of one or all experiments
+    handle
+        Run a request and return a response
+    """
+
+    def __init__(self):
+        self.basal_melts = {}
+        self.freshwaters = {}
+        self.client = None
+
+    def basalmelt(self, exp_name, gamma, name, start_dir, outpath, nemo_path, driver):
+        """Calculate basal melt for a leg and map it to a BISICLES AMR file
+        Args:
+            exp_name (str): experiment name
+            gamma (float): gamma value
+            name (str): name of basal melt file
+            start_dir (str): directory containing BasalMeltCoupling
+            outpath (str): BISICLES output path
+            nemo_path (str): NEMO output directory of the leg
+            driver (str): path to BISICLES nc2amr driver
+        Returns:
+            basal melt dataframe
+        """
+        path = start_dir + "/BasalMeltCoupling"
+        outpath = outpath + "/"
+        csv_out = new_path(outpath + "/csv/")
+        with IN.record(csv_out, exp_name, "basalmelt", PROFILE):
+            basal_melt = self.basalmelt_steps(
+                exp_name, gamma, name, path, outpath, nemo_path, driver
+            )
+        print("Basal Melt Calculated")
+        return basal_melt
+
+    def basalmelt_steps(self, exp_name, gamma, name, path, outpath, nemo_path, driver):
+        """Steps of the basal melt calculation, see basalmelt"""
+        new_path(outpath + "/plots/nc/")
+        new_path(outpath + "/plots/hdf5/")
+        csv_out = new_path(outpath + "/csv/")
+        cache_out = new_path(outpath + "/cache/")
+        checkpoint_out = new_path(outpath + CHECKPOINT_DIR)
+        thetao_file = sorted(iglob(nemo_path + "*_grid_T_3D.nc"))[0]
+        year = leg_year(thetao_file)
+        IN.annotate(year=year)
+
+        key = (path + AREA_FILE, float(gamma), cache_out, SECTOR_SET)
+        if key not in self.basal_melts:
+            self.basal_melts[key] = BM.BasalMelt(
+                thetao_file,
+                path + AREA_FILE,
+                float(gamma),
+                cache_out,
+                sector_set=SECTOR_SET,
+            )
+        ocean_temp = self.basal_melts[key]
+        ocean_temp.thetao = thetao_file
+        ocean_temp.checkpoints = CheckpointCache(checkpoint_out, exp_name)
+        if DASK_WORKERS and self.client is None:
+            self.client = local_client(DASK_WORKERS)
+        ocean_temp.client = self.client
+
+        with IN.stage("map_basalmelt"):
+            if MELT_FIELD:
+                basal_melt = ocean_temp.map_basalmelt_field(
+                    path + MASK_DIR, outpath, driver, name, MELT_FIELD
+                )
+            else:
+                basal_melt = ocean_temp.map_basalmelt(
+                    path + MASK_DIR, outpath, driver, name
+                )
+        with IN.stage("store_results"):
+            ResultsStore(csv_out).upsert(exp_name, "bm", basal_melt, year)
+        return basal_melt
+
+    def freshwater_instance(self, exp_name, flatten, outpath, amr_file1, amr_file2):
+        """Freshwater instance for the flatten driver, kept between legs
+        Args:
+            exp_name (str): experiment name
+            flatten (str): path to BISICLES flatten driver
+            outpath (str): BISICLES output path
+            amr_file1, amr_file2 (str): plot files of the two timesteps
+        Returns:
+            Freshwater
+        """
+        if flatten not in self.freshwaters:
+            self.freshwaters[flatten] = FW.Freshwater(flatten, amr_file1, amr_file2)
+        freshwater = self.freshwaters[flatten]
+        freshwater.amr_file1 = amr_file1
+        freshwater.amr_file2 = amr_file2
+        freshwater.checkpoints = CheckpointCache(
+            new_path(outpath + CHECKPOINT_DIR), exp_name
+        )
+        return freshwater
+
+    def prefetch_freshwater(self, exp_name, start_dir, flatten, outpath):
+        """Do the freshwater work that does not depend on the new plot file:
+        sum the latest existing plot file, which becomes the first timestep
+        once BISICLES has written the next one, and prepare the ocean
+        distribution kernel
+        Args:
+            exp_name (str): experiment name
+            start_dir (str): directory containing BasalMeltCoupling
+            flatten (str): path to BISICLES flatten driver
+            outpath (str): BISICLES output path
+        """
+        path = start_dir + "/BasalMeltCoupling"
+        plot_files = sorted(iglob(outpath + "/plots/hdf5/*.2d.hdf5"), reverse=True)
+        freshwater = self.freshwater_instance(exp_name, flatten, outpath, None, None)
+        cache_out = new_path(outpath + "/cache/")
+        with IN.stage("prefetch_freshwater"):
+            if plot_files:
+                freshwater.plot_sums(
+                    plot_files[0],
+                    path + MASK_DIR,
+                    outpath + "/plots/nc/",
+                    flatten,
+                    cache_dir=cache_out,
+                )
+            freshwater.distribution_kernel(
+                path + AREA_FILE,
+                path + BM_MASK_FILE,
+                path + CALVING_MASK_FILE,
+                cache_out,
+            )
+
+    def leg(self, *args):
+        """Run a whole leg through the pipelined scheduler
+        Args:
+            args: arguments of LegPipeline
+        """
+        pipeline = LegPipeline(self, *args)
+        csv_out = new_path(pipeline.outpath + "/csv/")
+        with IN.record(csv_out, pipeline.exp_name, "leg", PROFILE):
+            pipeline.run()
+
+    def freshwater(self, exp_name, start_dir, flatten, outpath, nemo_path, plot=None):
+        """Calculate freshwater input for a leg and write the NEMO forcing
+        file of the next year to the forcing directory of the experiment
+        Args:
+            exp_name (str): experiment name
+            start_dir (str): directory containing BasalMeltCoupling
+            flatten (str): path to BISICLES flatten driver
+            outpath (str): BISICLES output path
+            nemo_path (str): NEMO output directory of the leg
+            plot (str): plot file of the leg, the newest plot file if None. It
+            is compared with the plot file before it
+        Returns:
+            discharge and basal dataframes
+        """
+        path = start_dir + "/BasalMeltCoupling"
+        csv_out = new_path(outpath + "/csv/")
+        with IN.record(csv_out, exp_name, "freshwater", PROFILE):
+            return self.freshwater_steps(
+                exp_name, path, flatten, outpath, nemo_path, plot
+            )
+
+    def freshwater_steps(self, exp_name, path, flatten, outpath, nemo_path, plot=None):
+        """Steps of the freshwater calculation, see freshwater"""
+        nc_out = outpath + "/plots/nc/"
+        plot_path = outpath + "/plots/hdf5/"
+        csv_out = outpath + "/csv/"
+        cache_out = new_path(outpath + "/cache/")
+        thetao_file = sorted(iglob(nemo_path + "*_grid_T_3D.nc"))[0]
+        year = leg_year(thetao_file)
+        IN.annotate(year=year)
+
+        # Later plot files of a still running BISICLES job are not used
+        plot_files = sorted(iglob(plot_path + "*.2d.hdf5"))
+        names = [os.path.basename(file) for file in plot_files]
+        latest = len(names) - 1 if plot is None else names.index(os.path.basename(plot))
+        if latest < 1:
+            raise RuntimeError("no plot file to compare with in " + plot_path)
+        penultimate_file = plot_files[latest - 1]
+        latest_file = plot_files[latest]
+        print(penultimate_file, latest_file)
+
+        freshwater = self.freshwater_instance(
+            exp_name, flatten, outpath, penultimate_file, latest_file
+        )
+        with IN.stage("regional_contribution"):
+            discharge, basal = freshwater.regional_contribution(
+                path + MASK_DIR, nc_out, flatten, cache_dir=cache_out
+            )
+
+        with IN.stage("store_results"):
+            store = ResultsStore(csv_out)
+            store.upsert(exp_name, "discharge", discharge, year)
+            store.upsert(exp_name, "basal", basal, year)
+        print(discharge, basal)
+
+        with IN.stage("nemo_forcing"):
+            fwf_file = freshwater.calculate_nemo_forcing(
+                discharge,
+                basal,
+                path + AREA_FILE,
+                path + BM_MASK_FILE,
+                path + CALVING_MASK_FILE,
+                thetao_file,
+                cache_out,
+            )
+        print(fwf_file)
+        with IN.stage("write_forcing"):
+            forcing_file = freshwater.write_nemo_forcing(
+                fwf_file, new_path(path + FORCING_DIR + exp_name + "/")
+            )
+        print(forcing_file)
+        return discharge, basal
+
+    def evict_checkpoints(self, outpath, exp_name=None, max_age=None):
+        """Remove checkpoints of one or all experiments, optionally by age
+        Args:
+            outpath (str): BISICLES output path
+            exp_name (str): experiment to evict, all experiments if None
+            max_age (float): only remove checkpoints older than max_age seconds
+        Returns:
+            removed (int): number of removed checkpoints
+        """
+        if max_age is not None:
+            max_age = float(max_age)
+        checkpoints = CheckpointCache(outpath + CHECKPOINT_DIR, exp_name)
+        removed = checkpoints.evict(exp_name, max_age)
+        print("Removed", removed, "checkpoints")
+        return removed
+
+    def handle(self, request):
+        """Run a request and return a response
+        Args:
+            request (dict): {"task": "basalmelt", "freshwater", "leg" or "evict",
+            "args": [...]}
+        Returns:
+            response (dict): {"status": "ok"} or {"status": "error", "error": str}
+        """
+        tasks = {
+            "basalmelt": self.basalmelt,
+            "freshwater": self.freshwater,
+            "leg": self.leg,
+            "evict": self.evict_checkpoints,
+        }
+        try:
+            tasks[request["task"]](*request["args"])
+        except Exception:  # report to the client, keep serving
+            return {"status": "error", "error": traceback.format_exc()}
+        finally:
+            sys.stdout.flush()
+        return {"status": "ok"}
+
+
+class CouplingHandler(socketserver.StreamRequestHandler):
+    """Handler reading one JSON request line and writing one JSON response line"""
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode())
+        if request.get("task") == "ping":
+            response = {"status": "ok"}
+        elif request.get("task") == "shutdown":
+            response = {"status": "ok"}
+            self.server.running = False
+        else:
+            response = self.server.service.handle(request)
+        self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+class CouplingServer(socketserver.UnixStreamServer):
+    """Class for the coupling server, requests are run one at a time
+    ...
+
+    Attributes
+    ----------
+    socket_path (str): path of the Unix socket
+    service (CouplingService): coupling steps with warm state
+    running (bool): set to False by a shutdown request
+
+    Methods
+    -------
+    serve
+        Handle requests until a shutdown request arrives
+    """
+
+    def __init__(self, socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, CouplingHandler)
+        self.socket_path = socket_path
+        self.service = CouplingService()
+        self.running = True
+
+    def serve(self):
+        """Handle requests until a shutdown request arrives"""
+        try:
+            while self.running:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.socket_path)
+
+
+if __name__ == "__main__":
+    CouplingServer(sys.argv[1]).serve()
@@ -0,0 +1,48 @@
+"""Basal Melt Reprocessing
+
+This script recalculates sector temperatures and basal melt for every year
+of a set of EC-Earth ocean temperature files, spreading the files over a
+process pool. Invalid basal melt anomalies do not stop the run, they are
+written to <exp>_bm_reprocessed_report.csv.
+
+This script requires the experiment name, chosen gamma value, the path of the
+BasalMeltCoupling directory, an output path, a glob pattern of thetao files
+and optionally the number of worker processes.
+Requires the parallel module.
+"""
+
+import os
+import sys
+from freshwater_coupling import parallel as PAR
+
+# Define parameters
+EXP_NAME = str(sys.argv[1])
+GAMMA = float(sys.argv[2])
+
+# Define Paths
+PATH = str(sys.argv[3]) + "/BasalMeltCoupling"
+OUTPATH = str(sys.argv[4]) + "/"
+CSV_OUT = OUTPATH + "/csv/"
+CACHE_OUT = OUTPATH + "/cache/"
+
+AREA_FILE = (
+    PATH + "/inputs/ec-earth_data/areacello_Ofx_EC-Earth3_historical_r1i1p1f1_gn.nc"
+)
+
+THETAO_GLOB = str(sys.argv[5])
+PROCESSES = int(sys.argv[6]) if len(sys.argv) > 6 else None
+
+
+if __name__ == "__main__":
+    os.makedirs(CSV_OUT, exist_ok=True)
+    os.makedirs(CACHE_OUT, exist_ok=True)
+    DRIVER = PAR.ParallelBasalMelt(AREA_FILE, GAMMA, CACHE_OUT, PROCESSES)
+    THETAO, BASAL_MELT, REPORT = DRIVER.run(THETAO_GLOB)
+    DRIVER.to_file(THETAO, CSV_OUT + EXP_NAME + "_thetao_reprocessed.csv")
+    DRIVER.to_file(BASAL_MELT, CSV_OUT + EXP_NAME + "_bm_reprocessed.csv")
+    print(BASAL_MELT)
+    if len(REPORT) != 0:
+        REPORT.to_csv(CSV_OUT + EXP_NAME + "_bm_reprocessed_report.csv", index=False)
+        print("Invalid basal melt anomalies:")
+        print(REPORT.to_string(index=False))
+    print("Basal Melt Reprocessed")
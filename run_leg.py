@@ -0,0 +1,23 @@
+"""Coupling Leg
+
+This script runs one coupling leg: basal melt, BISICLES and freshwater,
+preparing the freshwater calculation while BISICLES is running.
+
+This script requires the experiment name, chosen gamma value, basal melt file
+name, start directory, BISICLES output path, NEMO output path of the leg,
+paths to the BISICLES nc2amr, flatten and driver executables and the path
+to the BISICLES input data. The same arguments can be sent to the coupling
+server as a leg request (see coupling_client.py).
+Requires the service module.
+"""
+
+import sys
+from freshwater_coupling import service as SRV
+
+if __name__ == "__main__":
+    try:
+        SRV.CouplingService().leg(*sys.argv[1:12])
+    except RuntimeError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+    print("Done!")
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from benchmarks.fixtures import IceFixture
+from freshwater_coupling.amr_tools import Flatten
+
+pytest.importorskip("h5py")
+
+
+def test_read_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    fields = {
+        "thickness": rng.normal(1000, 100, (5, 7)),
+        "activeBasalThicknessSource": rng.normal(0, 1, (5, 7)),
+    }
+    file = str(tmp_path / "plot.test.000001.2d.hdf5")
+    # Boxes of 3 cells, so the grid has partial boxes along both axes
+    IceFixture(str(tmp_path), "8km", box=3).write_plot(file, fields, 1000.0)
+
+    dat = Flatten(file).read(x0=-3500.0, y0=-2500.0)
+    assert dat["thickness"].dims == ("y", "x")
+    for name, field in fields.items():
+        np.testing.assert_array_equal(dat[name].values, field)
+    np.testing.assert_array_equal(dat["x"], -3500.0 + (np.arange(7) + 0.5) * 1000.0)
+    np.testing.assert_array_equal(dat["y"], -2500.0 + (np.arange(5) + 0.5) * 1000.0)
+
+    subset = Flatten(file).read(["activeBasalThicknessSource"])
+    assert list(subset.data_vars) == ["activeBasalThicknessSource"]
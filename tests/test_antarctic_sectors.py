@@ -0,0 +1,63 @@
+import shutil
+import numpy as np
+import pandas as pd
+import xarray as xr
+from freshwater_coupling.antarctic_sectors import LevermannSectors
+
+
+def write_masks(path, label):
+    """Write one (y, x) region mask file per Levermann region of a label raster"""
+    x = np.arange(label.shape[1]) * 1000.0
+    y = np.arange(label.shape[0]) * 1000.0
+    for k, name in enumerate(LevermannSectors.label_order):
+        xr.Dataset(
+            {"smask": (("y", "x"), (label == k + 1).astype(float))},
+            coords={"x": x, "y": y},
+        ).to_netcdf(path / ("levermann_" + name + "_1.2d.nc"))
+    return x, y
+
+
+def test_map2amr_non_square(tmp_path):
+    label = np.array([[0, 1, 2, 3], [4, 5, 0, 1], [2, 3, 4, 5]])
+    x, y = write_masks(tmp_path, label)
+    levermann = LevermannSectors()
+    basalmelt_df = pd.DataFrame(
+        [np.arange(1.0, len(levermann.label_order) + 1)],
+        columns=levermann.label_order,
+    )
+    levermann.map2amr(
+        str(tmp_path) + "/",
+        str(tmp_path) + "/",
+        shutil.which("true"),
+        "bm",
+        basalmelt_df,
+        str(tmp_path / "cache"),
+    )
+    with xr.open_dataset(tmp_path / "bm.nc") as ds:
+        assert ds["bm"].dims == ("y", "x")
+        np.testing.assert_array_equal(ds["x"], x)
+        np.testing.assert_array_equal(ds["y"], y)
+        np.testing.assert_array_equal(ds["bm"], label.astype(float))
+
+
+def test_map2amr_rows(tmp_path):
+    label = np.array([[1, 2, 0], [3, 4, 5]])
+    write_masks(tmp_path, label)
+    levermann = LevermannSectors()
+    basalmelt_df = pd.DataFrame(
+        [np.arange(1.0, 6.0), -np.arange(1.0, 6.0)],
+        index=[1850, 1851],
+        columns=levermann.label_order,
+    )
+    levermann.map2amr(
+        str(tmp_path) + "/",
+        str(tmp_path) + "/",
+        shutil.which("true"),
+        "bm",
+        basalmelt_df,
+        str(tmp_path / "cache"),
+    )
+    with xr.open_dataset(tmp_path / "bm.nc") as ds:
+        assert sorted(ds.data_vars) == ["bm_1850", "bm_1851"]
+        np.testing.assert_array_equal(ds["bm_1850"], label.astype(float))
+        np.testing.assert_array_equal(ds["bm_1851"], -label.astype(float))
@@ -0,0 +1,55 @@
+import numpy as np
+from freshwater_coupling.basal_melt import OceanData
+
+
+def nearest_above(my_array, target):
+    """Layer lookup before depth_index: nearest value greater than target"""
+    diff = my_array - target
+    return np.ma.masked_array(diff, np.ma.less_equal(diff, 0)).argmin()
+
+
+def nearest_below(my_array, target):
+    """Layer lookup before depth_index: nearest value smaller than target"""
+    diff = target - my_array
+    return np.ma.masked_array(diff, np.ma.less_equal(diff, 0)).argmin()
+
+
+def lev_bounds():
+    """(lev, 2) bounds of 75 layers thickening with depth, like ORCA1"""
+    edges = np.concatenate([[0.0], np.cumsum(np.geomspace(1.0, 250.0, 75))])
+    return np.column_stack([edges[:-1], edges[1:]])
+
+
+def test_depth_index_matches_nearest_lookup():
+    lev_bnds = lev_bounds()
+    rng = np.random.default_rng(0)
+    # Random depths and the layer bounds themselves, inside the grid
+    depths = np.concatenate(
+        [rng.uniform(lev_bnds[1, 0], lev_bnds[-2, 1], 500), lev_bnds[1:-1].ravel()]
+    )
+    tops = depths - rng.uniform(1, 200, depths.size)
+    tops = np.maximum(tops, lev_bnds[1, 0])
+    top_idx, bottom_idx = OceanData.depth_index(lev_bnds, tops, depths)
+    for top, bottom, top_k, bottom_k in zip(tops, depths, top_idx, bottom_idx):
+        assert top_k == nearest_below(lev_bnds[:, 0], top)
+        assert bottom_k == nearest_above(lev_bnds[:, 1], bottom)
+
+
+def test_depth_weights_match_layer_loop():
+    lev_bnds = lev_bounds()
+    shelf_depth = np.array([305.0, 312.0, 369.0, 420.0])
+    tops, bottoms = shelf_depth - 50, shelf_depth + 50
+    lev_weights = OceanData("thetao.nc", "area.nc").depth_weights(
+        lev_bnds, tops, bottoms
+    )
+    for k, (top, bottom) in enumerate(zip(tops, bottoms)):
+        lev_ind_bottom = nearest_above(lev_bnds[:, 1], bottom)
+        lev_ind_top = nearest_below(lev_bnds[:, 0], top)
+        lev_bnds_sel = np.array(lev_bnds[lev_ind_top : lev_ind_bottom + 1])
+        lev_bnds_sel[lev_bnds_sel > bottom] = bottom
+        lev_bnds_sel[lev_bnds_sel < top] = top
+        expected = np.zeros(lev_bnds.shape[0])
+        expected[lev_ind_top : lev_ind_bottom + 1] = (
+            lev_bnds_sel[:, 1] - lev_bnds_sel[:, 0]
+        )
+        np.testing.assert_array_equal(lev_weights[k], expected)
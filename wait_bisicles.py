@@ -0,0 +1,29 @@
+"""Wait for BISICLES
+
+This script waits until a submitted BISICLES job has finished, removes the
+sentinel file it touched and prints the path of its new plot file.
+
+This script requires the sentinel file touched by the job, the plot file
+directory, the experiment name and the error stream of the job.
+Exits with status 1 if the job reported an error and 3 if it finished
+without writing a plot file.
+Requires the bisicles_wait module.
+"""
+
+import sys
+from freshwater_coupling import bisicles_wait as BW
+
+SENTINEL = str(sys.argv[1])
+PLOT_PATH = str(sys.argv[2])
+EXP_NAME = str(sys.argv[3])
+ERR_FILE = str(sys.argv[4])
+
+if __name__ == "__main__":
+    try:
+        PLOT = BW.BisiclesWaiter(SENTINEL, PLOT_PATH, EXP_NAME, ERR_FILE).wait()
+    except RuntimeError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+    if PLOT is None:
+        sys.exit(3)
+    print(PLOT)